@@ -0,0 +1,131 @@
+import re
+import sys
+import numpy as np
+import pandas as pd
+
+
+class BinIndex:
+    """Array based index of the bins of a matrix.
+
+    The bin names (e.g. chr1-1000) are parsed only once into
+    - chrom_names: the chromosome names in the order of their first
+      occurrence
+    - chrom_codes: the position of the chromosome of each bin in
+      chrom_names (int32)
+    - starts: the start position of each bin (int64)
+    - offsets: the first bin of each chromosome followed by the number
+      of bins. Only available if the bins of each chromosome are
+      contiguous (which is the case for all matrices in Homer format).
+    """
+
+    def __init__(self, bin_names=None, chroms=None, starts=None):
+        if chroms is None:
+            chroms, starts = split_bin_names(bin_names)
+        chrom_codes, chrom_names = pd.factorize(
+            np.asarray(chroms, dtype=object))
+        self.chrom_names = [str(chrom) for chrom in chrom_names]
+        self.chrom_codes = chrom_codes.astype(np.int32)
+        self.starts = np.asarray(starts, dtype=np.int64)
+        self._chrom_to_code = dict(
+            (chrom, code) for code, chrom in enumerate(self.chrom_names))
+        self.is_contiguous = bool(np.all(np.diff(self.chrom_codes) >= 0))
+        self.offsets = None
+        if self.is_contiguous:
+            self.offsets = np.searchsorted(
+                self.chrom_codes, np.arange(len(self.chrom_names) + 1))
+
+    def __len__(self):
+        return len(self.starts)
+
+    def chrom_code(self, chrom):
+        return self._chrom_to_code[chrom]
+
+    def chroms(self):
+        """Return the chromosome name of each bin.
+        """
+        return np.asarray(self.chrom_names, dtype=object)[self.chrom_codes]
+
+    def chrom_positions(self, chrom):
+        """Return the positions of the bins of a chromosome - as slice if
+        the chromosomes are contiguous.
+        """
+        chrom_code = self.chrom_code(chrom)
+        if self.is_contiguous:
+            return slice(self.offsets[chrom_code],
+                         self.offsets[chrom_code + 1])
+        return np.flatnonzero(self.chrom_codes == chrom_code)
+
+    def region_positions(self, chrom, start=None, end=None):
+        """Return the positions of the bins of a chromosome that overlap
+        the range start to end (end excluded). The bin starts of a
+        chromosome have to be sorted. For contiguous chromosomes a slice
+        is returned.
+        """
+        chrom_positions = self.chrom_positions(chrom)
+        if start is None and end is None:
+            return chrom_positions
+        chrom_starts = self.starts[chrom_positions]
+        first = 0
+        if start is not None:
+            first = max(np.searchsorted(chrom_starts, start, "right") - 1, 0)
+        last = len(chrom_starts)
+        if end is not None:
+            last = np.searchsorted(chrom_starts, end, "left")
+        if isinstance(chrom_positions, slice):
+            return slice(chrom_positions.start + first,
+                         chrom_positions.start + max(last, first))
+        return chrom_positions[first:last]
+
+    def chrom_lengths(self):
+        """Return the largest bin start of each chromosome (in the order of
+        their first occurrence).
+        """
+        max_starts = np.zeros(len(self.chrom_names), dtype=np.int64)
+        np.maximum.at(max_starts, self.chrom_codes, self.starts)
+        return dict(zip(self.chrom_names, max_starts.tolist()))
+
+    def take(self, positions):
+        """Return the index of the bins at the given positions.
+        """
+        return BinIndex(chroms=self.chroms()[positions],
+                        starts=self.starts[positions])
+
+
+def parse_region(region):
+    """Parse a region string like chr2 or chr2:1,000,000-5,000,000 into
+    chromosome, start and end (start and end are None for whole
+    chromosomes).
+    """
+    match = re.fullmatch(r"(.+):([\d,]+)-([\d,]+)", region)
+    if match is None:
+        return region, None, None
+    chrom, start, end = match.groups()
+    return chrom, int(start.replace(",", "")), int(end.replace(",", ""))
+
+
+def bin_names_without_start(bin_names):
+    """Return the bin names that do not end with '-<start position>'.
+    """
+    bin_names = np.asarray(bin_names, dtype=object)
+    has_start = pd.Series(bin_names, dtype=object).str.fullmatch(
+        r".*-\d+").fillna(False).astype(bool)
+    return bin_names[~has_start.to_numpy()]
+
+
+def split_bin_names(bin_names):
+    """Split bin names into chromosome name and start position. Only the
+    last '-' is used as chromosome names can contain '-'.
+    """
+    invalid_bin_names = bin_names_without_start(bin_names)
+    if len(invalid_bin_names) > 0:
+        sys.stderr.write(f"The bin name '{invalid_bin_names[0]}' does not "
+                         "end with '-<start position>'. The chromosomes "
+                         "and positions of the bins are unknown.\n")
+        sys.exit(1)
+    chroms_and_starts = pd.Series(
+        np.asarray(bin_names, dtype=object), dtype=object).str.rsplit(
+            "-", n=1, expand=True)
+    if chroms_and_starts.empty:
+        return np.array([], dtype=object), np.array([], dtype=np.int64)
+    return (chroms_and_starts[0].to_numpy(dtype=object),
+            chroms_and_starts[1].astype(np.int64).to_numpy())
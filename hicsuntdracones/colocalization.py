@@ -1,6 +1,5 @@
 from hicsuntdracones.colocalization_base import ColocalizationBase
 import random
-from collections import defaultdict
 import numpy as np
 from scipy import stats
 import matplotlib.pyplot as plt
@@ -10,10 +9,10 @@ class ColocalizationTester(ColocalizationBase):
 
     def __init__(self, matrix_file, gff_file, feature, bin_size,
                  output_prefix, number_of_subsamplings, margin,
-                 flanks_only, remove_zeros):
+                 flanks_only, remove_zeros, dtype=None):
         super().__init__(matrix_file, gff_file, feature, bin_size,
                  output_prefix, number_of_subsamplings, margin,
-                 flanks_only, remove_zeros)
+                 flanks_only, remove_zeros, dtype=dtype)
         self._interaction_matrix = None
         self._randomly_picked_bins = []
         self._feature_bin_countings = None
@@ -31,11 +30,7 @@ class ColocalizationTester(ColocalizationBase):
         """For each feature of interest generate a equivalently long one from
         a random position and extract the ovelapping bins..
         """
-        chrom_and_length = defaultdict(int)
-        for genome_bin in self._interaction_matrix["Regions"]:
-            chrom, length = genome_bin.split("-")
-            if chrom_and_length[chrom] < int(length):
-                chrom_and_length[chrom] = int(length)
+        chrom_and_length = self._bin_index.chrom_lengths()
         random.seed(1)
         for feature_of_interest in self._features.features_of_type(
             self._feature):
@@ -102,7 +97,7 @@ def analyse_colocalization(args):
     colocalization_tester = ColocalizationTester(
         args.matrix_file, args.gff_file, args.feature, args.bin_size,
         args.output_prefix, args.number_of_subsamplings, args.margin,
-        args.flanks_only, args.remove_zeros)
+        args.flanks_only, args.remove_zeros, dtype=args.dtype)
     colocalization_tester.read_gff_file()
     colocalization_tester.generate_interaction_matrix()
     colocalization_tester.extract_features_overlapping_bins()
@@ -111,9 +106,3 @@ def analyse_colocalization(args):
     colocalization_tester.perform_t_test()
     colocalization_tester.write_countings_for_file()
     colocalization_tester.plot_distribution()
-
-
-def remove_position_information(name_with_pos_info):
-    # Return just the chromosome part without the exact window
-    # location
-    return "-".join(name_with_pos_info.split("-")[:-1])
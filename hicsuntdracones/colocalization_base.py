@@ -12,8 +12,9 @@ class ColocalizationBase:
 
     def __init__(self, matrix_file, gff_file, feature, bin_size,
                  output_prefix, number_of_subsamplings, margin,
-                 flanks_only, remove_zeros):
+                 flanks_only, remove_zeros, dtype=None):
         self._matrix_file = matrix_file
+        self._dtype = dtype
         self._gff_file = gff_file
         self._feature = feature
         self._bin_size = int(bin_size)
@@ -23,6 +24,7 @@ class ColocalizationBase:
         self._flanks_only = flanks_only
         self._remove_zeros = remove_zeros
         self._features = None
+        self._bin_index = None
         self._feature_overlapping_bins = []
         '''
         #for later use
@@ -57,19 +59,19 @@ pybedtools.example_bedtool('a.bed')\
 #-----
         '''
     def add_matrix_bins_as_features(self, matrix_file, features):
-        hic_matrix = hicsuntdracones.hicmatrix.HiCMatrix(matrix_file)
+        hic_matrix = hicsuntdracones.hicmatrix.HiCMatrix(
+            matrix_file, dtype=self._dtype)
         hic_matrix.normalize_by_columns_sum()
+        self._bin_index = hic_matrix.bin_index
         interaction_matrix = hic_matrix.hic_matrix_df
         interaction_matrix.set_index(
             interaction_matrix["Regions"], inplace=True)
 
-        for genome_bin in interaction_matrix["Regions"]:
-            chrom_part = "-".join(genome_bin.split("-")[:-1])
-            # As the bin counting starts with 0 but the gff starts at 1
-            # we have to add 1 here to the position.
-            # pos = int(genome_bin.split("-")[-1]) + 1
-            pos = int(genome_bin.split("-")[-1])
-            pos_adjusted = pos + 1
+        # As the bin counting starts with 0 but the gff starts at 1
+        # we have to add 1 here to the position.
+        for genome_bin, chrom_part, pos_adjusted in zip(
+                hic_matrix.bins(), self._bin_index.chroms(),
+                (self._bin_index.starts + 1).tolist()):
             features.update([gffutils.Feature(
                 seqid=chrom_part,
                 source='-',
@@ -168,18 +170,15 @@ pybedtools.example_bedtool('a.bed')\
         from a given matrix.
         """
         combined_interaction_countings = []
-        for interaction_bin in bin_list:
+        bin_list = np.asarray(bin_list, dtype=object)
+        chrom_codes = self._bin_index.chrom_codes[
+            interaction_matrix.index.get_indexer(bin_list)]
+        for interaction_bin, chrom_code in zip(bin_list, chrom_codes):
             # Only count the interaction with bins on other
             # chromosomes and cores only
-            other_bins = bin_list.copy()
-            other_bins.remove(interaction_bin)
-            chrom = interaction_bin.split("-")[0]
             #  Interchromosomal only i.e. have to be located on other
             #  chromosomes.
-            other_bins = list(filter(
-                lambda interaction_bin:
-                not interaction_bin.startswith(chrom),
-                other_bins))
+            other_bins = bin_list[chrom_codes != chrom_code]
             interaction_countings = interaction_matrix.loc[
                 [interaction_bin], other_bins]
             combined_interaction_countings.extend(
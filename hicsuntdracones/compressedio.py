@@ -0,0 +1,117 @@
+from contextlib import contextmanager
+import gzip
+import io
+import os
+import shutil
+import signal
+import subprocess
+import sys
+
+COMPRESSION_SUFFIXES = {".gz": "gzip", ".zst": "zstd"}
+
+
+def compression_of(path: str):
+    """Return the compression of a file ("gzip" or "zstd") as given by
+    its suffix or None for uncompressed files.
+    """
+    return COMPRESSION_SUFFIXES.get(os.path.splitext(path)[1])
+
+
+def is_compressed(path: str):
+    return compression_of(path) is not None
+
+
+def default_threads():
+    return os.cpu_count() or 1
+
+
+def _compressor_command(compression, mode, threads):
+    """Return the command line of the external (de)compressor or None if
+    no suitable tool is installed. pigz and zstd use several threads.
+    The (de)compression runs in a separate process, i.e. in parallel to
+    the parsing or formatting of the values.
+    """
+    decompress = ["-d"] if mode.startswith("r") else []
+    if compression == "gzip":
+        if shutil.which("pigz"):
+            return ["pigz", "-c", "-p", str(threads)] + decompress
+        if shutil.which("gzip"):
+            return ["gzip", "-c"] + decompress
+    elif compression == "zstd" and shutil.which("zstd"):
+        return ["zstd", "-c", "-q", f"-T{threads}"] + decompress
+    return None
+
+
+@contextmanager
+def open_file(path: str, mode="r", threads=None):
+    """Open a plain, gzip (.gz) or zstd (.zst) compressed file for
+    reading ("r", "rb") or writing ("w", "wb"). Compressed files are
+    piped through pigz/gzip or zstd. Without these tools gzip files are
+    handled by the gzip module.
+    """
+    compression = compression_of(path)
+    if compression is None:
+        with open(path, mode) as file_handle:
+            yield file_handle
+        return
+    if threads is None:
+        threads = default_threads()
+    command = _compressor_command(compression, mode, threads)
+    if command is None:
+        if compression != "gzip":
+            sys.stderr.write(f"Please install {compression} to read and "
+                             f"write {path}.\n")
+            sys.exit(1)
+        with gzip.open(path, mode if "b" in mode else mode + "t") as (
+                file_handle):
+            yield file_handle
+        return
+    if mode.startswith("r"):
+        with open(path, "rb") as input_fh:
+            process = subprocess.Popen(command, stdin=input_fh,
+                                       stdout=subprocess.PIPE)
+        pipe = process.stdout
+    else:
+        with open(path, "wb") as output_fh:
+            process = subprocess.Popen(command, stdin=subprocess.PIPE,
+                                       stdout=output_fh)
+        pipe = process.stdin
+    file_handle = pipe if "b" in mode else io.TextIOWrapper(pipe)
+    try:
+        yield file_handle
+    except BaseException:
+        # Keep the original exception instead of reporting the
+        # (de)compressor that was interrupted by it
+        _abort_pipe(process, file_handle)
+        raise
+    _close_pipe(process, file_handle, mode, path)
+
+
+def _abort_pipe(process, file_handle):
+    """Stop the (de)compressor and close the pipe without checking the
+    exit status.
+    """
+    process.terminate()
+    try:
+        file_handle.close()
+    except OSError:
+        pass
+    process.wait()
+
+
+def _close_pipe(process, file_handle, mode, path):
+    """Close the pipe and wait for the (de)compressor. A decompressor is
+    stopped by SIGPIPE if the file was not read completely (e.g. only
+    the header line).
+    """
+    try:
+        file_handle.close()
+    except BrokenPipeError:
+        pass
+    return_code = process.wait()
+    if return_code == 0 or (
+            mode.startswith("r") and return_code == -signal.SIGPIPE):
+        return
+    action = "read" if mode.startswith("r") else "write"
+    sys.stderr.write(f"Could not {action} the compressed file {path}.\n")
+    sys.exit(1)
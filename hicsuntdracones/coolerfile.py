@@ -0,0 +1,253 @@
+from contextlib import contextmanager
+import datetime
+import json
+import sys
+import numpy as np
+import pandas as pd
+from scipy import sparse
+from hicsuntdracones.binindex import BinIndex
+
+COOLER_SUFFIXES = (".cool", ".mcool")
+
+
+def split_cooler_uri(uri: str):
+    """Split a cooler URI like matrix.mcool::resolutions/10000 into the
+    path of the file and the group of the matrix in the file ("" if no
+    group is given).
+    """
+    path, _, group = uri.partition("::")
+    return path, group
+
+
+def is_cooler_file(uri: str):
+    return split_cooler_uri(uri)[0].endswith(COOLER_SUFFIXES)
+
+
+def cooler_group(h5_file, group=""):
+    """Return the group of the matrix. For multi-resolution files without
+    given group the finest resolution is used.
+    """
+    if group:
+        return h5_file[group]
+    if "resolutions" in h5_file:
+        resolutions = sorted(h5_file["resolutions"], key=int)
+        return h5_file["resolutions"][resolutions[0]]
+    return h5_file["/"]
+
+
+@contextmanager
+def open_cooler(uri: str):
+    # h5py is only needed for cooler files
+    import h5py
+    path, group = split_cooler_uri(uri)
+    with h5py.File(path, "r") as h5_file:
+        yield cooler_group(h5_file, group)
+
+
+def read_cooler_bins(uri: str):
+    """Return the bin names (e.g. chr1-10000) and the bin index of the
+    matrix.
+    """
+    with open_cooler(uri) as cooler:
+        chrom_names = np.array([
+            name.decode() for name in cooler["chroms/name"][:]],
+            dtype=object)
+        chroms = chrom_names[cooler["bins/chrom"][:]]
+        starts = cooler["bins/start"][:].astype(np.int64)
+    bin_names = (pd.Series(chroms, dtype=object) + "-" +
+                 pd.Series(starts).astype(str)).to_numpy(dtype=object)
+    return bin_names, BinIndex(chroms=chroms, starts=starts)
+
+
+def read_cooler_pixels(uri: str, positions=slice(None), dtype=None):
+    """Return the upper triangle (incl. the diagonal) of the submatrix of
+    the bins at the given (ascending) positions as CSR matrix. Only the
+    pixels of the rows of these bins are read, contiguous rows with one
+    read call per dataset.
+    """
+    with open_cooler(uri) as cooler:
+        bin1_offset = cooler["indexes/bin1_offset"][:]
+        number_of_bins = len(bin1_offset) - 1
+        positions = np.arange(number_of_bins)[positions]
+        new_positions = np.full(number_of_bins, -1, dtype=np.int64)
+        new_positions[positions] = np.arange(len(positions))
+        rows, cols, counts = [], [], []
+        for row_run in np.split(
+                positions, np.flatnonzero(np.diff(positions) != 1) + 1):
+            if len(row_run) == 0:
+                continue
+            first_pixel = bin1_offset[row_run[0]]
+            last_pixel = bin1_offset[row_run[-1] + 1]
+            run_rows = new_positions[
+                cooler["pixels/bin1_id"][first_pixel:last_pixel]]
+            run_cols = new_positions[
+                cooler["pixels/bin2_id"][first_pixel:last_pixel]]
+            run_counts = cooler["pixels/count"][first_pixel:last_pixel]
+            # Pixels of bins that are not selected and - for files in
+            # square storage mode - of the lower triangle are skipped
+            keep = run_cols >= run_rows
+            rows.append(run_rows[keep])
+            cols.append(run_cols[keep])
+            counts.append(run_counts[keep])
+        count_dtype = cooler["pixels/count"].dtype
+    if dtype is None:
+        dtype = count_dtype
+    if not rows:
+        return sparse.csr_matrix((len(positions), len(positions)),
+                                 dtype=dtype)
+    return sparse.csr_matrix(
+        (np.concatenate(counts).astype(dtype, copy=False),
+         (np.concatenate(rows), np.concatenate(cols))),
+        shape=(len(positions), len(positions)))
+
+
+def cooler_min_value(uri: str, chunk_size=10000000):
+    """Return the smallest value of the matrix without building it.
+    Cells without pixel have the value 0.
+    """
+    with open_cooler(uri) as cooler:
+        counts = cooler["pixels/count"]
+        number_of_bins = len(cooler["bins/start"])
+        min_value = None
+        for start in range(0, len(counts), chunk_size):
+            chunk_min = np.nanmin(counts[start:start + chunk_size])
+            if min_value is None or chunk_min < min_value:
+                min_value = chunk_min
+        if len(counts) < number_of_bins * (number_of_bins + 1) // 2:
+            min_value = 0 if min_value is None else min(min_value, 0)
+    return min_value
+
+
+def write_cooler(hic_matrix, uri: str, chunk_size=1000):
+    """Write the matrix as cooler (format version 3, symmetric upper
+    storage). Only nonzero values are stored as pixels. The matrix is
+    converted block by block of chunk_size rows. For multi-resolution
+    files (.mcool) the matrix is added as resolutions/<bin size> unless
+    a group is given in the URI - an existing matrix of this group is
+    replaced.
+
+    The bin ends are the start of the next bin of the chromosome and for
+    the last bin of each chromosome its start plus the bin size.
+    """
+    import h5py
+    bin_index = hic_matrix.bin_index
+    if not bin_index.is_contiguous:
+        sys.stderr.write("The bins of each chromosome have to be "
+                         "contiguous to write a cooler file.\n")
+        sys.exit(1)
+    ends, bin_size = _bin_ends(bin_index)
+    path, group = split_cooler_uri(uri)
+    if path.endswith(".mcool") and not group:
+        if bin_size is None:
+            sys.stderr.write("The bins differ in size. Please give the "
+                             "group of the matrix in the .mcool file.\n")
+            sys.exit(1)
+        group = f"resolutions/{bin_size}"
+    with h5py.File(path, "a" if group else "w") as h5_file:
+        if group:
+            if group in h5_file:
+                del h5_file[group]
+            cooler = h5_file.require_group(group)
+            if path.endswith(".mcool"):
+                h5_file.attrs["format"] = "HDF5::MCOOL"
+                h5_file.attrs["format-version"] = 2
+        else:
+            cooler = h5_file["/"]
+        _write_cooler_chroms_and_bins(cooler, bin_index, ends)
+        nnz, bin1_offset = _write_cooler_pixels(
+            cooler, hic_matrix, chunk_size)
+        indexes = cooler.create_group("indexes")
+        indexes.create_dataset("chrom_offset", data=bin_index.offsets)
+        indexes.create_dataset("bin1_offset", data=bin1_offset)
+        cooler.attrs["format"] = "HDF5::Cooler"
+        cooler.attrs["format-version"] = 3
+        cooler.attrs["bin-type"] = "variable" if bin_size is None else (
+            "fixed")
+        if bin_size is not None:
+            cooler.attrs["bin-size"] = bin_size
+        cooler.attrs["storage-mode"] = "symmetric-upper"
+        cooler.attrs["nbins"] = len(bin_index)
+        cooler.attrs["nchroms"] = len(bin_index.chrom_names)
+        cooler.attrs["nnz"] = nnz
+        cooler.attrs["generated-by"] = "hicsuntdracones"
+        cooler.attrs["creation-date"] = (
+            datetime.datetime.now().isoformat())
+        cooler.attrs["metadata"] = json.dumps({})
+
+
+def _bin_ends(bin_index):
+    """Return the end of each bin and the bin size (None if the bins do
+    not all have the same size).
+    """
+    next_starts = np.append(bin_index.starts[1:], -1)
+    last_bins = bin_index.offsets[1:] - 1
+    bin_sizes = np.delete(next_starts - bin_index.starts, last_bins)
+    bin_size = None
+    if len(bin_sizes) > 0 and np.all(bin_sizes == bin_sizes[0]):
+        bin_size = int(bin_sizes[0])
+    last_bin_size = bin_size
+    if last_bin_size is None:
+        last_bin_size = int(bin_sizes.max()) if len(bin_sizes) > 0 else 1
+    ends = next_starts.copy()
+    ends[last_bins] = bin_index.starts[last_bins] + last_bin_size
+    return ends, bin_size
+
+
+def _write_cooler_chroms_and_bins(cooler, bin_index, ends):
+    import h5py
+    chrom_names = np.array(bin_index.chrom_names, dtype="S")
+    chroms = cooler.create_group("chroms")
+    chroms.create_dataset("name", data=chrom_names)
+    chroms.create_dataset(
+        "length", data=ends[bin_index.offsets[1:] - 1].astype(np.int32))
+    bins = cooler.create_group("bins")
+    chrom_enum = h5py.enum_dtype(
+        dict((name, code) for code, name in enumerate(
+            bin_index.chrom_names)), basetype=np.int32)
+    bins.create_dataset("chrom", data=bin_index.chrom_codes,
+                        dtype=chrom_enum)
+    bins.create_dataset("start", data=bin_index.starts)
+    bins.create_dataset("end", data=ends)
+
+
+def _write_cooler_pixels(cooler, hic_matrix, chunk_size):
+    """Write the nonzero values of the upper triangle row by row and
+    return their number and the first pixel of each row.
+    """
+    number_of_bins = hic_matrix.number_of_bins
+    pixels = cooler.create_group("pixels")
+    value_dtype = hic_matrix._values.dtype
+    datasets = [pixels.create_dataset(
+        name, shape=(0,), maxshape=(None,), dtype=dtype, chunks=True,
+        compression="gzip", shuffle=True) for name, dtype in (
+            ("bin1_id", np.int64), ("bin2_id", np.int64),
+            ("count", value_dtype))]
+    pixels_per_row = np.zeros(number_of_bins, dtype=np.int64)
+    nnz = 0
+    # Only advanced for matrices that are written from dense blocks
+    dense_row_blocks = hic_matrix._dense_row_blocks(chunk_size)
+    for start in range(0, number_of_bins, chunk_size):
+        end = min(start + chunk_size, number_of_bins)
+        if hic_matrix.is_sparse() and hic_matrix._fill_value == 0:
+            block = hic_matrix._values[start:end].tocoo()
+            block.sum_duplicates()
+            block_rows, block_cols, block_values = (
+                block.row, block.col, block.data)
+            nonzero = block_values != 0
+            block_rows, block_cols, block_values = (
+                block_rows[nonzero], block_cols[nonzero],
+                block_values[nonzero])
+        else:
+            _, block = next(dense_row_blocks)
+            block = np.triu(block, k=start)
+            block_rows, block_cols = np.nonzero(block)
+            block_values = block[block_rows, block_cols]
+        if len(block_rows) > 0:
+            for dataset, data in zip(datasets, (
+                    block_rows + start, block_cols, block_values)):
+                dataset.resize((nnz + len(data),))
+                dataset[nnz:] = data
+        pixels_per_row[start:end] = np.bincount(
+            block_rows, minlength=end - start)
+        nnz += len(block_rows)
+    return nnz, np.concatenate(([0], np.cumsum(pixels_per_row)))
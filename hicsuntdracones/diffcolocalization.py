@@ -1,6 +1,5 @@
 from hicsuntdracones.colocalization_base import ColocalizationBase
 import random
-from collections import defaultdict
 import numpy as np
 from scipy import stats
 import matplotlib.pyplot as plt
@@ -10,11 +9,11 @@ class DiffColocalizationTester(ColocalizationBase):
 
     def __init__(self, matrix_file, other_matrix_file, gff_file, feature, bin_size,
                  output_prefix, number_of_subsamplings, margin,
-                 flanks_only, remove_zeros):
+                 flanks_only, remove_zeros, dtype=None):
         self._other_matrix_file = other_matrix_file
         super().__init__(matrix_file, gff_file, feature, bin_size,
                          output_prefix, number_of_subsamplings, margin,
-                         flanks_only, remove_zeros)
+                         flanks_only, remove_zeros, dtype=dtype)
         self._interaction_matrix_1 = None
         self._interaction_matrix_2 = None
         self._randomly_picked_bin_lists = []
@@ -51,11 +50,7 @@ class DiffColocalizationTester(ColocalizationBase):
         """
         # Will become a list of lists
 
-        chrom_and_length = defaultdict(int)
-        for genome_bin in self._interaction_matrix_1["Regions"]:
-            chrom, length = genome_bin.split("-")
-            if chrom_and_length[chrom] < int(length):
-                chrom_and_length[chrom] = int(length)
+        chrom_and_length = self._bin_index.chrom_lengths()
         random.seed(1)
         subsampling = self._number_of_subsamplings
         while subsampling > 0:
@@ -187,7 +182,7 @@ def analyse_diff_colocalization(args):
     diff_colocalization_tester = DiffColocalizationTester(
         args.matrix_file_1, args.matrix_file_2, args.gff_file, args.feature,
         args.bin_size, args.output_prefix, args.number_of_subsamplings,
-        args.margin, args.flanks_only, args.remove_zeros)
+        args.margin, args.flanks_only, args.remove_zeros, dtype=args.dtype)
     diff_colocalization_tester.read_gff_file()
     diff_colocalization_tester.generate_both_interaction_matrices()
     diff_colocalization_tester.extract_features_overlapping_bins()
@@ -1,55 +1,326 @@
 from collections import defaultdict
+import contextlib
+import multiprocessing
+import sys
 import numpy as np
+import pandas as pd
 import matplotlib
 matplotlib.use("Agg")
 from matplotlib.backends.backend_pdf import PdfPages
 import matplotlib.pyplot as plt
 import hicsuntdracones.hicmatrix
+from hicsuntdracones.coolerfile import is_cooler_file
+from hicsuntdracones.sharedmatrix import shared_hic_matrix
+
+
+class DistanceStatistics:
+    """Number, mean and sum of squared deviations from the mean (M2) of
+    the countings of each chromosome and distance. The countings are
+    added chunk by chunk and merged with Welford's (parallel) algorithm,
+    so only these three values per distance are kept.
+    """
+
+    def __init__(self):
+        self._chroms_aggregates_by_dist = defaultdict(dict)
+
+    def add(self, chrom, dist, countings):
+        countings = np.asarray(countings, dtype=float)
+        if len(countings) == 0:
+            return
+        number = len(countings)
+        mean = np.mean(countings)
+        deviations = countings - mean
+        m2 = np.sum(deviations * deviations)
+        self._add_aggregates(chrom, dist, number, mean, m2)
+
+    def _add_aggregates(self, chrom, dist, number, mean, m2):
+        aggregates_by_dist = self._chroms_aggregates_by_dist[chrom]
+        if dist in aggregates_by_dist:
+            number_a, mean_a, m2_a = aggregates_by_dist[dist]
+            delta = mean - mean_a
+            total_number = number_a + number
+            mean = mean_a + delta * number / total_number
+            m2 = m2_a + m2 + delta * delta * number_a * number / (
+                total_number)
+            number = total_number
+        aggregates_by_dist[dist] = (number, mean, m2)
+
+    def update(self, statistics):
+        """Merge the aggregates of other statistics into these ones.
+        """
+        for chrom in statistics.chroms():
+            for dist in statistics.dists(chrom):
+                self._add_aggregates(
+                    chrom, dist,
+                    *statistics._chroms_aggregates_by_dist[chrom][dist])
+
+    def chroms(self):
+        return list(self._chroms_aggregates_by_dist.keys())
+
+    def dists(self, chrom):
+        return sorted(self._chroms_aggregates_by_dist[chrom].keys())
+
+    def number(self, chrom, dist):
+        return self._chroms_aggregates_by_dist[chrom][dist][0]
+
+    def mean(self, chrom, dist):
+        return self._chroms_aggregates_by_dist[chrom][dist][1]
+
+    def std(self, chrom, dist):
+        number, _, m2 = self._chroms_aggregates_by_dist[chrom][dist]
+        return np.sqrt(m2 / number)
+
+    def arrays(self, chrom):
+        """Return the (sorted) distances and the number and the mean of
+        the countings of each distance as arrays.
+        """
+        dists = self.dists(chrom)
+        aggregates_by_dist = self._chroms_aggregates_by_dist[chrom]
+        return (np.array(dists, dtype=float),
+                np.array([aggregates_by_dist[dist][0] for dist in dists],
+                         dtype=np.int64),
+                np.array([aggregates_by_dist[dist][1] for dist in dists],
+                         dtype=float))
+
+
+def log_binned_contact_probability(dists, numbers, means, bin_size,
+                                   bins_per_decade=10):
+    """Return the contact probability P(s) of one chromosome in
+    geometrically growing distance bins (bins_per_decade bins per factor
+    of ten, with edges rounded up to multiples of bin_size) as
+    DataFrame.
+
+    P(s) is the mean counting of the bin pairs with a distance in the
+    distance bin divided by the sum of all countings of the chromosome.
+    Distance is the geometric mean of the distances of these pairs. The
+    slope is the local exponent of the power law P(s) ~ s^slope, i.e.
+    the derivative of log P(s) by log s (from the neighbouring distance
+    bins). The distance 0 (the pairs of a bin with itself) is not
+    binned.
+    """
+    sums = numbers * means
+    total = np.sum(sums)
+    binned = dists > 0
+    dists, numbers, sums = dists[binned], numbers[binned], sums[binned]
+    columns = ["Distance start", "Distance end", "Distance",
+               "Number of pairs", "Mean counting value",
+               "Contact probability", "Slope"]
+    if len(dists) == 0:
+        return pd.DataFrame(columns=columns)
+    exponents = np.arange(
+        int(np.ceil(np.log10(dists[-1] / bin_size) * bins_per_decade)) + 2)
+    edges = np.unique(np.ceil(10 ** (exponents / bins_per_decade))) * (
+        bin_size)
+    bins = np.searchsorted(edges, dists, side="right") - 1
+    used_bins = np.unique(bins)
+    bin_numbers = np.bincount(bins, weights=numbers)[used_bins]
+    bin_means = np.bincount(bins, weights=sums)[used_bins] / bin_numbers
+    bin_dists = bin_size * np.exp(np.bincount(
+        bins, weights=numbers * np.log(dists / bin_size))[used_bins] /
+        bin_numbers)
+    with np.errstate(divide="ignore", invalid="ignore"):
+        contact_probabilities = bin_means / total
+        if len(used_bins) > 1:
+            slopes = np.gradient(np.log(contact_probabilities),
+                                 np.log(bin_dists))
+        else:
+            slopes = np.full(len(used_bins), np.nan)
+    return pd.DataFrame(dict(zip(columns, (
+        edges[used_bins], edges[used_bins + 1], bin_dists,
+        bin_numbers.astype(np.int64), bin_means, contact_probabilities,
+        slopes))))
+
+
+def chrom_decay(hic_matrix, chrom, bin_size, keep_countings=False):
+    """Return the statistics of the countings of the chromosome by
+    distance and - with keep_countings=True - the countings of each
+    distance (None otherwise).
+    """
+    statistics = DistanceStatistics()
+    countings_by_dist = {} if keep_countings else None
+    # Only intra-chromosomal interactions are considered
+    submatrix = hic_matrix.select_region(chrom)
+    for offset, diagonal in submatrix.iter_diagonals():
+        dist = float(offset * bin_size)
+        statistics.add(chrom, dist, diagonal)
+        if keep_countings:
+            countings_by_dist[dist] = diagonal.astype(float)
+    return statistics, countings_by_dist
+
+
+def _shared_chrom_decay(arguments):
+    """Worker of the process pool: load the shared (or inherited) matrix
+    (or read the cooler file) and calculate the decay of one chromosome.
+    """
+    matrix_source, chrom, bin_size, keep_countings = arguments
+    if isinstance(matrix_source, tuple):
+        matrix_file, read_kwargs = matrix_source
+        hic_matrix = hicsuntdracones.hicmatrix.read_hic_matrix(
+            matrix_file, use_cache=False, **read_kwargs)
+    else:
+        hic_matrix = matrix_source.load()
+    return chrom_decay(hic_matrix, chrom, bin_size, keep_countings)
 
 
 class DistDepDecayOutputGenerator:
 
-    def __init__(self, matrix_file, bin_size, output_prefix):
-        hic_matrix = hicsuntdracones.hicmatrix.HiCMatrix(matrix_file)
+    def __init__(self, matrix_file, bin_size, output_prefix, sparse=False,
+                 dtype=None, packed=False, keep_countings=False,
+                 processes=1):
+        """The countings are aggregated per chromosome and distance while
+        going through the diagonals of each chromosome, so only a few
+        values per distance are kept. The single countings (needed for
+        the Countings column of the table and the plot of all values)
+        are only kept if requested with keep_countings=True.
+
+        With processes > 1 the chromosomes are distributed to a pool of
+        worker processes. The matrix is shared with the workers (see
+        hicsuntdracones.sharedmatrix), cooler files are read by the
+        workers themselves. The results are merged in the order of the
+        chromosomes, so they do not depend on the number of processes.
+
+        An existing binary cache of a dense matrix (see
+        hicsuntdracones.hicmatrix.read_hic_matrix) is memory mapped
+        instead of parsing the matrix file.
+        """
+        values_file = None
+        if (not sparse and not packed and not is_cooler_file(matrix_file)
+                and hicsuntdracones.hicmatrix.binary_cache_is_current(
+                    matrix_file, dtype=dtype)):
+            values_file = hicsuntdracones.hicmatrix.binary_cache_file(
+                matrix_file, dtype)
+        # Cooler files are read lazily so that only the intra-chromosomal
+        # pixels are read
+        hic_matrix = hicsuntdracones.hicmatrix.read_hic_matrix(
+            matrix_file, use_cache=values_file is not None, sparse=sparse,
+            dtype=dtype, packed=packed)
         self._output_prefix = output_prefix
-        self._chroms_dists_and_countings = (
-            hic_matrix.calc_distance_dependent_decay(bin_size))
-        # Just a different arrangement of the data:
-        self._chroms_countings_by_dist = defaultdict(
-            lambda: defaultdict(list))
-        for chrom in self._chroms_dists_and_countings.keys():
-            for dist, counting in zip(
-                    self._chroms_dists_and_countings[chrom]["dists"],
-                    self._chroms_dists_and_countings[chrom]["countings"]):
-                self._chroms_countings_by_dist[chrom][dist].append(
-                    counting)
+        self._bin_size = bin_size
+        self._statistics = DistanceStatistics()
+        self._chroms_countings_by_dist = None
+        if keep_countings:
+            self._chroms_countings_by_dist = defaultdict(dict)
+        chromosomes = hic_matrix.chromosomes
+        if processes > 1 and len(chromosomes) > 1:
+            chrom_results = self._chrom_results_in_parallel(
+                hic_matrix, matrix_file, chromosomes, bin_size,
+                keep_countings, processes,
+                dict(sparse=sparse, dtype=dtype, packed=packed),
+                values_file)
+        else:
+            chrom_results = (
+                chrom_decay(hic_matrix, chrom, bin_size, keep_countings)
+                for chrom in chromosomes)
+        for chrom, (statistics, countings_by_dist) in zip(
+                chromosomes, chrom_results):
+            self._statistics.update(statistics)
+            if keep_countings:
+                self._chroms_countings_by_dist[chrom] = countings_by_dist
+
+    def _chrom_results_in_parallel(self, hic_matrix, matrix_file,
+                                   chromosomes, bin_size, keep_countings,
+                                   processes, read_kwargs, values_file):
+        with contextlib.ExitStack() as stack:
+            if is_cooler_file(matrix_file):
+                matrix_source = (matrix_file, read_kwargs)
+            else:
+                # The pool has to be started after the matrix is shared
+                matrix_source = stack.enter_context(
+                    shared_hic_matrix(hic_matrix, values_file=values_file))
+            pool = stack.enter_context(multiprocessing.Pool(
+                min(processes, len(chromosomes))))
+            return pool.map(_shared_chrom_decay, [
+                (matrix_source, chrom, bin_size, keep_countings)
+                for chrom in chromosomes], chunksize=1)
 
     def write_table_file(self):
+        """The Countings column is empty if the single countings were not
+        kept.
+        """
         sep = ", "
         with open(f"{self._output_prefix}_distance_dependent_decay.csv", "w") as output_fh:
             output_fh.write("Chrom\tDist\tMean counting value\t"
                             "Counting standard deviation\t"
                             "Countings\tNumber of countings\n")
-            for chrom in self._chroms_dists_and_countings.keys():
-                for dist in sorted(self._chroms_countings_by_dist[
-                        chrom].keys()):
-                    countings = self._chroms_countings_by_dist[chrom][dist]
-                    counting_mean = np.mean(countings)
-                    counting_stand_dev = np.std(countings)
+            for chrom in self._statistics.chroms():
+                for dist in self._statistics.dists(chrom):
+                    counting_mean = self._statistics.mean(chrom, dist)
+                    counting_stand_dev = self._statistics.std(chrom, dist)
+                    countings = ""
+                    if self._chroms_countings_by_dist is not None:
+                        countings = sep.join([
+                            str(count) for count in
+                            self._chroms_countings_by_dist[chrom][dist]])
                     output_fh.write(
                         f"{chrom}\t{dist}\t{counting_mean}\t{counting_stand_dev}\t"
-                        f"{sep.join([str(count) for count in countings])}\t{len(countings)}\n")
+                        f"{countings}\t{self._statistics.number(chrom, dist)}\n")
+
+    def write_npz_file(self):
+        """Write the table as compressed NumPy file
+        (<output_prefix>_distance_dependent_decay.npz) with one array per
+        column: chrom, dist, mean, std and n. If the single countings
+        were kept they are stored as the arrays countings (the countings
+        of all rows one after the other) and countings_offsets (the
+        first counting of each row followed by the number of countings),
+        i.e. the countings of row i are
+        countings[countings_offsets[i]:countings_offsets[i + 1]].
+        """
+        chroms, dists, means, stds, numbers = [], [], [], [], []
+        for chrom in self._statistics.chroms():
+            chrom_dists = self._statistics.dists(chrom)
+            chroms.extend([chrom] * len(chrom_dists))
+            dists.extend(chrom_dists)
+            means.extend(self._statistics.mean(chrom, dist)
+                         for dist in chrom_dists)
+            stds.extend(self._statistics.std(chrom, dist)
+                        for dist in chrom_dists)
+            numbers.extend(self._statistics.number(chrom, dist)
+                           for dist in chrom_dists)
+        columns = {"chrom": np.array(chroms, dtype=str),
+                   "dist": np.array(dists, dtype=float),
+                   "mean": np.array(means, dtype=float),
+                   "std": np.array(stds, dtype=float),
+                   "n": np.array(numbers, dtype=np.int64)}
+        if self._chroms_countings_by_dist is not None:
+            countings = [self._chroms_countings_by_dist[chrom][dist]
+                         for chrom, dist in zip(chroms, dists)]
+            columns["countings"] = np.concatenate(
+                [np.zeros(0)] + countings)
+            columns["countings_offsets"] = np.concatenate(
+                ([0], np.cumsum([len(row_countings)
+                                 for row_countings in countings]))).astype(
+                                     np.int64)
+        np.savez_compressed(
+            f"{self._output_prefix}_distance_dependent_decay.npz",
+            **columns)
+
+    def write_contact_probability_file(self, bins_per_decade=10):
+        """Write the log-binned contact probability P(s) and its slope of
+        each chromosome (see log_binned_contact_probability). Only the
+        aggregates of the distances are needed, not the single
+        countings.
+        """
+        tables = []
+        for chrom in self._statistics.chroms():
+            table = log_binned_contact_probability(
+                *self._statistics.arrays(chrom), self._bin_size,
+                bins_per_decade=bins_per_decade)
+            table.insert(0, "Chrom", chrom)
+            tables.append(table)
+        with open(f"{self._output_prefix}_contact_probability.csv", "w") as output_fh:
+            pd.concat(tables, ignore_index=True).to_csv(
+                output_fh, sep="\t", index=False)
 
     def plot_bin_averages(self):
         _pp_av = PdfPages(
             f"{self._output_prefix}_distance_dependent_decay_averages.pdf")
         plt.style.use('ggplot')
-        for chrom in self._chroms_countings_by_dist.keys():
+        for chrom in self._statistics.chroms():
             fig = plt.figure()
             ax = fig.add_subplot(1, 1, 1)
-            dists = sorted(self._chroms_countings_by_dist[chrom].keys())
-            counting_means = [np.mean(self._chroms_countings_by_dist[
-                chrom][dist]) for dist in dists]
+            dists = self._statistics.dists(chrom)
+            counting_means = [self._statistics.mean(chrom, dist)
+                              for dist in dists]
             ax.plot(dists, counting_means, "-", alpha=0.5, color="black")
             # ax.set_ylim([0, 20])
             ax.set_title(chrom)
@@ -61,15 +332,14 @@ class DistDepDecayOutputGenerator:
         _pp_av = PdfPages(
             f"{self._output_prefix}_distance_dependent_decay_averages_with_error_bars.pdf")
         plt.style.use('ggplot')
-        for chrom in self._chroms_countings_by_dist.keys():
+        for chrom in self._statistics.chroms():
             fig = plt.figure()
             ax = fig.add_subplot(1, 1, 1)
-            dists = sorted(self._chroms_countings_by_dist[
-                chrom].keys())
-            counting_means = [np.mean(self._chroms_countings_by_dist[
-                chrom][dist]) for dist in dists]
-            counting_stand_dev = [np.std(self._chroms_countings_by_dist[
-                chrom][dist]) for dist in dists]
+            dists = self._statistics.dists(chrom)
+            counting_means = [self._statistics.mean(chrom, dist)
+                              for dist in dists]
+            counting_stand_dev = [self._statistics.std(chrom, dist)
+                                  for dist in dists]
             ax.errorbar(dists, counting_means, yerr=counting_stand_dev,
                         color="black")
             # ax.set_xscale("log")
@@ -85,14 +355,22 @@ class DistDepDecayOutputGenerator:
         _pp_av.close()
                     
     def plot_all_values(self):
+        if self._chroms_countings_by_dist is None:
+            sys.stderr.write("The single countings were not kept. Please "
+                             "use --with_countings (keep_countings=True) "
+                             "to plot all values.\n")
+            sys.exit(1)
         self._pp = PdfPages(f"{self._output_prefix}_distance_dependent_decay_all_values.pdf")
         plt.style.use('ggplot')
-        for chrom in self._chroms_dists_and_countings.keys():
+        for chrom in self._chroms_countings_by_dist.keys():
             fig = plt.figure()
             ax = fig.add_subplot(1, 1, 1)
+            countings_by_dist = self._chroms_countings_by_dist[chrom]
             ax.plot(
-                self._chroms_dists_and_countings[chrom]["dists"],
-                self._chroms_dists_and_countings[chrom]["countings"],
+                np.repeat(list(countings_by_dist.keys()), [
+                    len(countings) for countings in
+                    countings_by_dist.values()]),
+                np.concatenate(list(countings_by_dist.values())),
                 ".", alpha=0.5)
             ax.set_title(chrom)
             self._pp.savefig(fig)
@@ -1,24 +1,231 @@
-from scipy import ndimage
-from matplotlib.backends.backend_pdf import PdfPages
+from collections import defaultdict
+import functools
+from scipy import sparse
+import os
 import sys
 import numpy as np
 import pandas as pd
-import matplotlib.pyplot as plt
-import seaborn as sns
-import matplotlib
-import holoviews as hv
-matplotlib.use("Agg")
-hv.extension('bokeh')
+from hicsuntdracones.binindex import (
+    BinIndex, bin_names_without_start, parse_region)
+from hicsuntdracones.compressedio import is_compressed, open_file
+from hicsuntdracones.coolerfile import (
+    cooler_min_value, is_cooler_file, read_cooler_bins, read_cooler_pixels,
+    write_cooler)
+from hicsuntdracones.rowindex import get_row_index
+
+BINARY_CACHE_SUFFIX = ".hicsd.npy"
+BINS_CACHE_SUFFIX = ".hicsd.bins"
+SOURCE_CACHE_SUFFIX = ".source"
 
 
 class HiCMatrix:
 
-    def __init__(self, hic_matrix_file=None, hic_matrix_df=None):
+    def __init__(self, hic_matrix_file=None, hic_matrix_df=None,
+                 values=None, bin_names=None, fill_value=0.0,
+                 sparse=False, bin_index=None, lazy=False, dtype=None,
+                 packed=False, row_index=None):
+        """The values are either kept as dense array or - with sparse=True -
+        as scipy.sparse CSR matrix of the upper triangle (incl. the
+        diagonal). In the sparse case all cells that are not stored have
+        the value fill_value and the stored values are relative to it.
+
+        With packed=True only the upper triangle (incl. the diagonal) of
+        the symmetric matrix is stored as one-dimensional array, row by
+        row. This needs about half of the memory of the dense array.
+        The values of the lower triangle are mirrored when the dense
+        values are requested (e.g. by hic_matrix_df).
+
+        With lazy=True only the header of the matrix file is read. The
+        values are read when they are accessed for the first time. If a
+        row_index (see hicsuntdracones.rowindex) of the file is given,
+        select_region reads only the rows of the regions from the file
+        as long as the values are not loaded.
+
+        With dtype (e.g. "float32") the values are parsed, stored and
+        calculated in this data type. By default the data type is the
+        one pandas infers from the file (float64 for decimal values).
+
+        Files ending with .cool or .mcool (optionally followed by the
+        group of the matrix, e.g. matrix.mcool::resolutions/10000) are
+        read as cooler files. If such a matrix is lazy, select_region
+        reads only the pixels of the regions from the file.
+        """
+        self._dtype = None if dtype is None else np.dtype(dtype)
+        self._row_index = row_index
+        self._hic_matrix_df = None
+        self._loaded_values = None
+        self._lazy = False
+        if sparse and packed:
+            sys.stderr.write("A matrix can either be sparse or packed.\n")
+            sys.exit(1)
         if hic_matrix_file is not None:
             self._hic_matrix_file = hic_matrix_file
-            self._read_matrix()
+            self._sparse = sparse
+            self._packed = packed
+            if lazy:
+                self._read_header()
+                self._lazy = True
+            else:
+                self._load_values()
         elif hic_matrix_df is not None:
             self.hic_matrix_df = hic_matrix_df
+            if sparse:
+                self._set_values(sparse_upper_triangle(self._values),
+                                 self._bin_names, bin_index=self._bin_index)
+            elif packed:
+                self._set_values(pack_upper_triangle(self._values),
+                                 self._bin_names, bin_index=self._bin_index)
+        elif values is not None:
+            if packed and values.ndim == 2:
+                values = pack_upper_triangle(values)
+            self._set_values(values, bin_names, fill_value=fill_value,
+                             bin_index=bin_index)
+
+    @property
+    def hic_matrix_df(self):
+        """The matrix in Homer layout. It is generated on demand from the
+        value block and shares its memory. For sparse and packed matrices
+        the full dense matrix is generated.
+        """
+        if self._hic_matrix_df is None:
+            self._hic_matrix_df = pd.DataFrame(
+                self._dense_values(), columns=self._bin_names, copy=False)
+            self._hic_matrix_df.insert(0, "Regions", self._bin_names)
+            self._hic_matrix_df.insert(0, "HiCMatrix", self._bin_names)
+        return self._hic_matrix_df
+
+    @hic_matrix_df.setter
+    def hic_matrix_df(self, hic_matrix_df):
+        self._set_values(hic_matrix_df.iloc[0:, 2:].to_numpy(
+                             dtype=self._dtype),
+                         hic_matrix_df["Regions"].to_numpy(dtype=object))
+
+    @property
+    def _values(self):
+        if self._lazy:
+            self._lazy = False
+            self._load_values()
+        return self._loaded_values
+
+    @_values.setter
+    def _values(self, values):
+        self._loaded_values = values
+
+    def _set_values(self, values, bin_names, fill_value=0.0,
+                    bin_index=None):
+        """Store the value block (bins x bins) and the bin names. If no bin
+        index is given, the bin names are parsed when the index is used
+        for the first time. Values of a different data type are converted
+        to the data type of the matrix.
+        """
+        if self._dtype is not None:
+            if values is not None and values.dtype != self._dtype:
+                values = values.astype(self._dtype)
+            fill_value = self._dtype.type(fill_value)
+        self._values = values
+        self._lazy = False
+        self._fill_value = fill_value
+        self._bin_names = np.asarray(bin_names, dtype=object)
+        self._hic_matrix_df = None
+        self._bin_index = bin_index
+        self.number_of_bins = len(self._bin_names)
+
+    @property
+    def bin_index(self):
+        """The index of the chromosomes and start positions of the bins.
+        It is built on demand, so matrices with bin names without start
+        position can be read as long as no region is needed.
+        """
+        if self._bin_index is None:
+            self._bin_index = BinIndex(bin_names=self._bin_names)
+        return self._bin_index
+
+    @property
+    def chromosomes(self):
+        return self._chromosomes()
+
+    def is_sparse(self):
+        return sparse.issparse(self._values)
+
+    def is_packed(self):
+        return not self.is_sparse() and self._values.ndim == 1
+
+    def _dense_values(self, start=0, end=None):
+        """Return the (sub-)block of rows start to end as dense array.
+        """
+        if self.is_packed():
+            return self._unpack_rows(start, end)
+        if not self.is_sparse():
+            return self._values[start:end]
+        dense_values = self._symmetric_values()[start:end].toarray()
+        if self._fill_value != 0:
+            dense_values += self._fill_value
+        return dense_values
+
+    def _dense_row_blocks(self, chunk_size=1000):
+        """Yield the first row and the dense values of each block of
+        chunk_size rows. The upper triangle of a sparse matrix is mirrored
+        only once for all blocks.
+        """
+        if not self.is_sparse():
+            for start in range(0, self.number_of_bins, chunk_size):
+                yield start, self._dense_values(start, start + chunk_size)
+            return
+        symmetric_values = self._symmetric_values()
+        for start in range(0, self.number_of_bins, chunk_size):
+            dense_values = symmetric_values[start:start + chunk_size].toarray()
+            if self._fill_value != 0:
+                dense_values += self._fill_value
+            yield start, dense_values
+
+    def _symmetric_values(self):
+        """Mirror the stored upper triangle of a sparse matrix.
+        """
+        upper = self._values.tocsr()
+        return (upper + sparse.triu(upper, k=1).T).tocsr()
+
+    def _unpack_rows(self, start=0, end=None):
+        """Mirror the packed upper triangle into the dense rows start to
+        end.
+        """
+        number_of_bins = self.number_of_bins
+        start, end, _ = slice(start, end).indices(number_of_bins)
+        offsets = packed_row_offsets(number_of_bins)
+        rows = np.empty((max(end - start, 0), number_of_bins),
+                        dtype=self._values.dtype)
+        for row in range(start, end):
+            # The values left of the diagonal are stored in the column
+            # of this row in the rows above
+            rows[row - start, :row] = self._values[
+                offsets[:row] + row - np.arange(row)]
+            rows[row - start, row:] = self._values[
+                offsets[row]:offsets[row] + number_of_bins - row]
+        return rows
+
+    def _load_values(self):
+        if self._is_cooler():
+            self._read_cooler()
+        elif self._sparse:
+            self._read_matrix_sparse()
+        elif self._packed:
+            self._read_matrix_packed()
+        else:
+            self._read_matrix()
+
+    def _read_header(self):
+        """Read only the first line of the matrix file, which contains
+        the names of all bins.
+        """
+        if self._is_cooler():
+            bin_names, bin_index = read_cooler_bins(self._hic_matrix_file)
+            self._set_values(None, bin_names, bin_index=bin_index)
+            return
+        self._check_file()
+        with open_file(self._hic_matrix_file) as matrix_fh:
+            header = matrix_fh.readline().rstrip("\n").split("\t")
+        self._check_hic_matrix_df(pd.DataFrame(columns=header),
+                                  check_shape=False)
+        self._set_values(None, header[2:])
 
     def _read_matrix(self):
         """
@@ -35,120 +242,584 @@ class HiCMatrix:
 
         """
         self._check_file()
-        self.hic_matrix_df = pd.read_csv(self._hic_matrix_file, sep="\t")
-        self._check_hic_matrix_df()
-        self.number_of_bins = self.hic_matrix_df.shape[0]
-        self.chromosomes = self._chromosomes()
+        with open_file(self._hic_matrix_file, "rb") as matrix_fh:
+            hic_matrix_df = pd.read_csv(matrix_fh, sep="\t",
+                                        dtype=self._csv_dtypes())
+        self._check_hic_matrix_df(hic_matrix_df)
+        self.hic_matrix_df = hic_matrix_df
 
+    def _read_matrix_sparse(self, chunk_size=1000):
+        """Read the Homer file in blocks of rows and keep only the nonzero
+        values of the upper triangle so that the dense matrix never has
+        to be held in memory.
+        """
+        self._check_file()
+        rows, cols, data = [], [], []
+        bin_names = []
+        first_row = 0
+        for chunk in read_homer_chunks(self._hic_matrix_file, chunk_size,
+                                       self._csv_dtypes()):
+            if first_row == 0:
+                self._check_hic_matrix_df(chunk, check_shape=False)
+            block = np.triu(chunk.iloc[0:, 2:].to_numpy(), k=first_row)
+            block_rows, block_cols = np.nonzero(block)
+            rows.append(block_rows + first_row)
+            cols.append(block_cols)
+            data.append(block[block_rows, block_cols])
+            bin_names.extend(chunk["Regions"])
+            first_row += chunk.shape[0]
+        if first_row != chunk.shape[1] - 2:
+            sys.stderr.write("Unexpected ratio of columns and rows."
+                             "Is this really a HiC matrix in Homer format?")
+            sys.exit(1)
+        self._set_values(sparse.csr_matrix(
+            (np.concatenate(data),
+             (np.concatenate(rows), np.concatenate(cols))),
+            shape=(first_row, first_row)), bin_names)
+
+    def _is_cooler(self):
+        return is_cooler_file(self._hic_matrix_file)
+
+    def _read_cooler(self):
+        bin_names, bin_index = read_cooler_bins(self._hic_matrix_file)
+        self._set_values(self._cooler_values(), bin_names,
+                         bin_index=bin_index)
+
+    def _cooler_values(self, positions=slice(None)):
+        """Read the values of the bins at the given positions from the
+        cooler file - stored as sparse, packed or dense values.
+        """
+        return upper_triangle_values(
+            read_cooler_pixels(self._hic_matrix_file, positions,
+                               dtype=self._dtype),
+            sparse=self._sparse, packed=self._packed)
+
+    def _csv_dtypes(self):
+        """Data types for pandas.read_csv so that the values are directly
+        parsed in the data type of the matrix.
+        """
+        if self._dtype is None:
+            return None
+        return defaultdict(lambda: self._dtype, HiCMatrix=object,
+                           Regions=object)
+
+    def _read_matrix_packed(self, chunk_size=1000):
+        """Read the Homer file in blocks of rows and copy the upper
+        triangle of each row into the packed array.
+        """
+        self._check_file()
+        packed_values = None
+        bin_names = []
+        first_row = 0
+        for chunk in read_homer_chunks(self._hic_matrix_file, chunk_size,
+                                       self._csv_dtypes()):
+            block = chunk.iloc[0:, 2:].to_numpy()
+            if packed_values is None:
+                self._check_hic_matrix_df(chunk, check_shape=False)
+                number_of_bins = block.shape[1]
+                offsets = packed_row_offsets(number_of_bins)
+                packed_values = np.empty(
+                    number_of_bins * (number_of_bins + 1) // 2,
+                    dtype=block.dtype)
+            elif block.dtype != packed_values.dtype:
+                # pandas infers the data type for each chunk separately
+                packed_values = packed_values.astype(
+                    np.result_type(packed_values.dtype, block.dtype))
+            if first_row + block.shape[0] > number_of_bins:
+                sys.stderr.write("Unexpected ratio of columns and rows."
+                                 "Is this really a HiC matrix in Homer "
+                                 "format?")
+                sys.exit(1)
+            for block_row, row in enumerate(
+                    range(first_row, first_row + block.shape[0])):
+                packed_values[offsets[row]:offsets[row] + (
+                    number_of_bins - row)] = block[block_row, row:]
+            bin_names.extend(chunk["Regions"])
+            first_row += block.shape[0]
+        if first_row != number_of_bins:
+            sys.stderr.write("Unexpected ratio of columns and rows."
+                             "Is this really a HiC matrix in Homer format?")
+            sys.exit(1)
+        self._set_values(packed_values, bin_names)
 
     def _check_file(self):
         # TODO
         # check if file contains "HiCMatrix" and "Regions"
         pass
 
-    def _check_hic_matrix_df(self):
-        no_of_rows, no_of_columns = self.hic_matrix_df.shape
-        if not no_of_columns - 2 == no_of_rows:
+    def _check_hic_matrix_df(self, hic_matrix_df, check_shape=True):
+        no_of_rows, no_of_columns = hic_matrix_df.shape
+        if check_shape and not no_of_columns - 2 == no_of_rows:
             sys.stderr.write("Unexpected ratio of columns and rows."
                              "Is this really a HiC matrix in Homer format?")
             sys.exit(1)
-        if not self.hic_matrix_df.columns[0] == "HiCMatrix":
+        if not hic_matrix_df.columns[0] == "HiCMatrix":
             sys.stderr.write("Missing column 'HiCMatrix'."
                              "Is this really a HiC matrix in Homer format?")
             sys.exit(1)
-        if not self.hic_matrix_df.columns[1] == "Regions":
+        if not hic_matrix_df.columns[1] == "Regions":
             sys.stderr.write("Missing column 'Regions'."
                              "Is this really a HiC matrix in Homer format?")
             sys.exit(1)
 
-    def save(self, output_hic_matrix_file):
-        self.hic_matrix_df.to_csv(output_hic_matrix_file, sep="\t",
-                                  index=False)
+    def save(self, output_hic_matrix_file, chunk_size=1000):
+        if is_cooler_file(output_hic_matrix_file):
+            write_cooler(self, output_hic_matrix_file, chunk_size=chunk_size)
+            return
+        if not self.is_sparse() and not self.is_packed():
+            with open_file(output_hic_matrix_file, "w") as output_fh:
+                self.hic_matrix_df.to_csv(output_fh, sep="\t", index=False)
+            return
+        # Sparse and packed matrices are written in blocks of rows to
+        # avoid generating the full dense matrix
+        with open_file(output_hic_matrix_file, "w") as output_fh:
+            write_homer_header(output_fh, self._bin_names)
+            for start, dense_values in self._dense_row_blocks(chunk_size):
+                write_homer_rows(
+                    output_fh, dense_values,
+                    self._bin_names[start:start + chunk_size])
 
     def normalize_by_columns_sum(self, inplace=True):
-        """
+        """Divide all values by the median of the column sums.
         Assumption: input is an iced matrix.
+
+        Float values are divided in place. Integer values (e.g. raw
+        counts) are replaced by a float copy. With inplace=False this
+        matrix is not changed and a new HiCMatrix is returned.
         """
-        # Inplace parameter is coded but not used, To be used in future for further feature
-        column_sum_median = self._calc_column_sum_median()
-        for column in self.hic_matrix_df.columns:
-            if column in ["HiCMatrix", "Regions"]:
-                continue
-            if inplace:
-                self.hic_matrix_df[column] = self.hic_matrix_df[column] / column_sum_median
-            else:
+        column_sum_median = self.column_sum_median()
+        values = self._values
+        if inplace and np.issubdtype(values.dtype, np.floating):
+            # For sparse matrices the stored values are divided directly
+            # as scipy would multiply with the reciprocal
+            divided_values = values.data if self.is_sparse() else values
+            np.divide(divided_values, column_sum_median, out=divided_values)
+        elif self.is_sparse():
+            values = values.copy()
+            values.data = values.data / column_sum_median
+        else:
+            values = values / column_sum_median
+        fill_value = self._fill_value / column_sum_median
+        if not inplace:
+            return HiCMatrix(values=values, bin_names=self._bin_names,
+                             fill_value=fill_value, bin_index=self._bin_index,
+                             dtype=self._dtype)
+        self._set_values(values, self._bin_names, fill_value=fill_value,
+                         bin_index=self._bin_index)
 
-                pass
+    def column_sum_median(self):
+        """Return the median of the column sums in the data type of the
+        matrix. If the values are not loaded yet, it is taken from the
+        row index (if given).
+        """
+        if self._lazy and self._row_index is not None:
+            column_sum_median = self._row_index.column_sum_median()
+        else:
+            column_sum_median = self._calc_column_sum_median()
+        if self._dtype is not None:
+            # Otherwise numpy would calculate in float64
+            column_sum_median = self._dtype.type(column_sum_median)
+        return column_sum_median
 
     def _calc_column_sum_median(self):
         """Needed as the sums are not completely identical and some row sums
         are 0. Assumption: input is an iced matrix.
         """
-        return np.median([
-            self.hic_matrix_df[col].sum()
-            for col in self.hic_matrix_df.columns[2:]])
+        if self.is_sparse():
+            upper = self._values
+            column_sums = (np.asarray(upper.sum(axis=0)).ravel()
+                           + np.asarray(upper.sum(axis=1)).ravel()
+                           - upper.diagonal()
+                           + self._fill_value * self.number_of_bins)
+            return np.median(column_sums)
+        if self.is_packed():
+            column_sums = np.zeros(self.number_of_bins)
+            for row, offset in enumerate(
+                    packed_row_offsets(self.number_of_bins)):
+                row_values = self._values[
+                    offset:offset + self.number_of_bins - row]
+                column_sums[row:] += row_values
+                # The mirrored values of the lower triangle
+                column_sums[row] += row_values[1:].sum()
+            return np.median(column_sums)
+        column_sums = self._values.sum(axis=0)
+        if np.isnan(column_sums).any():
+            # Missing values are skipped like in pandas
+            column_sums = np.nansum(self._values, axis=0)
+        return np.median(column_sums)
 
     def _chromosomes(self):
-        return sorted(self.hic_matrix_df[
-            "Regions"].apply(remove_position_information).unique())
+        return sorted(self.bin_index.chrom_names)
 
     def select(self, keep_pattern=None, remove_pattern=None, regex_mode=False, inplace=False):
         """Select a submatrix based on given filters of the bin names.
         We like minimalism => Removing is stronger than keeping.
         """
+        values, bin_names, bin_index = self._select(
+            keep_pattern=keep_pattern, remove_pattern=remove_pattern,
+            regex_mode=regex_mode)
         if inplace:
-            self.hic_matrix_df = self._select(keep_pattern=keep_pattern,
-                                              remove_pattern=remove_pattern,
-                                              regex_mode=regex_mode)
+            self._set_values(values, bin_names, fill_value=self._fill_value,
+                             bin_index=bin_index)
         else:
-            return HiCMatrix(hic_matrix_df=self._select(keep_pattern=keep_pattern,
-                                                        remove_pattern=remove_pattern,
-                                                        regex_mode=regex_mode))
+            return HiCMatrix(values=values, bin_names=bin_names,
+                             fill_value=self._fill_value,
+                             bin_index=bin_index, dtype=self._dtype)
 
     def _select(self, keep_pattern=None, remove_pattern=None, regex_mode=False):
         filtered_bins = self.bins()
-        print(filtered_bins)
         if keep_pattern is not None:
             filtered_bins = filtered_bins[
                 filtered_bins.str.contains(keep_pattern, regex=regex_mode)]
         if remove_pattern is not None:
             filtered_bins = filtered_bins[
                 ~ filtered_bins.str.contains(remove_pattern, regex=regex_mode)]
-        print(filtered_bins)
-        # Filter columns
-        submatrix = self.hic_matrix_df[
-            ["HiCMatrix", "Regions"] + filtered_bins.tolist()]
-        # Filter rows
-        submatrix = submatrix[
-            submatrix["HiCMatrix"].isin(filtered_bins.tolist())]
-        #  As the index still based on the odering before
-        #  removing row the index has to be written.
-        submatrix.index = range(len(submatrix))
-
-        return submatrix
+        return self._take(filtered_bins.index.to_numpy())
+
+    def select_region(self, *regions, inplace=False):
+        """Select a submatrix of one or more regions like chr2 or
+        chr2:1,000,000-5,000,000 (end excluded). The bins are kept in the
+        order of the matrix.
+
+        The positions are looked up in the bin index. If the selected
+        bins are contiguous the values of a dense matrix are a view of
+        the values of this matrix - in-place operations on the
+        submatrix change this matrix, too.
+        """
+        positions = self._region_positions(regions)
+        if self._lazy and self._is_cooler():
+            values = self._cooler_values(positions)
+            bin_names = self._bin_names[positions]
+            bin_index = self.bin_index.take(positions)
+        elif self._lazy and self._row_index is not None:
+            positions = np.arange(self.number_of_bins)[positions]
+            values = self._row_index.read_rows(
+                self._hic_matrix_file, positions, positions,
+                dtype=self._dtype)
+            bin_names = self._bin_names[positions]
+            bin_index = self.bin_index.take(positions)
+        elif isinstance(positions, slice) and not self.is_packed():
+            values = self._values[positions, positions]
+            if self.is_sparse():
+                values = values.tocsr()
+            bin_names = self._bin_names[positions]
+            bin_index = self.bin_index.take(positions)
+        else:
+            values, bin_names, bin_index = self._take(positions)
+        if inplace:
+            self._set_values(values, bin_names, fill_value=self._fill_value,
+                             bin_index=bin_index)
+        else:
+            return HiCMatrix(values=values, bin_names=bin_names,
+                             fill_value=self._fill_value,
+                             bin_index=bin_index, dtype=self._dtype)
+
+    def _region_positions(self, regions):
+        """Return the positions of the bins of the regions - as slice if
+        they are contiguous.
+        """
+        region_positions = []
+        for region in regions:
+            chrom, start, end = parse_region(region)
+            if chrom not in self.bin_index.chrom_names:
+                sys.stderr.write(f"Unknown chromosome '{chrom}'.\n")
+                sys.exit(1)
+            region_positions.append(self.bin_index.region_positions(
+                chrom, start, end))
+        if len(region_positions) == 1 and isinstance(
+                region_positions[0], slice):
+            return region_positions[0]
+        positions = np.unique(np.concatenate([
+            np.arange(self.number_of_bins)[positions]
+            for positions in region_positions]))
+        if len(positions) > 0 and (
+                positions[-1] - positions[0] + 1 == len(positions)):
+            return slice(positions[0], positions[-1] + 1)
+        return positions
+
+    def _take(self, positions):
+        """Return the values, names and index of the bins at the given
+        (ascending) positions. For sparse matrices the result is again
+        an upper triangle, for packed matrices again packed.
+        """
+        if self.is_packed():
+            positions = np.arange(self.number_of_bins)[positions]
+            offsets = packed_row_offsets(self.number_of_bins)
+            values = np.empty(len(positions) * (len(positions) + 1) // 2,
+                              dtype=self._values.dtype)
+            for index, (row, offset) in enumerate(zip(
+                    positions, packed_row_offsets(len(positions)))):
+                values[offset:offset + len(positions) - index] = (
+                    self._values[offsets[row] + positions[index:] - row])
+        elif self.is_sparse():
+            values = self._values[positions][:, positions]
+        else:
+            values = self._values[np.ix_(positions, positions)]
+        bin_index = None
+        if self._bin_index is not None:
+            bin_index = self._bin_index.take(positions)
+        return values, self._bin_names[positions], bin_index
+
+    def rows(self, positions):
+        """Return the dense rows at the given positions. If the values
+        are not loaded yet and a row index is given only these rows are
+        read from the file.
+        """
+        positions = np.asarray(positions, dtype=np.int64)
+        if self._lazy and self._row_index is not None:
+            unique_positions, inverse = np.unique(
+                positions, return_inverse=True)
+            return self._row_index.read_rows(
+                self._hic_matrix_file, unique_positions,
+                dtype=self._dtype)[inverse]
+        return self._dense_values()[positions]
 
     def bins(self):
-        return self.hic_matrix_df["Regions"].rename("bins", inplace=True)
+        return pd.Series(self._bin_names, name="bins")
+
+    def scale_bins(self, positions, factor):
+        """Multiply the values of all pairs of the bins at the given
+        positions (i.e. of their submatrix) by factor in place. Integer
+        values are converted to float for non-integer factors. For
+        sparse matrices only the stored values are multiplied, so the
+        fill value has to be 0.
+        """
+        positions = np.arange(self.number_of_bins)[positions]
+        values = self._scalable_values(factor)
+        if self.is_sparse():
+            in_bins = np.zeros(self.number_of_bins, dtype=bool)
+            in_bins[positions] = True
+            rows = np.repeat(np.arange(self.number_of_bins),
+                             np.diff(values.indptr))
+            values.data[in_bins[rows] & in_bins[values.indices]] *= factor
+        elif self.is_packed():
+            offsets = packed_row_offsets(self.number_of_bins)
+            for index, row in enumerate(positions):
+                values[offsets[row] + positions[index:] - row] *= factor
+        else:
+            values[np.ix_(positions, positions)] *= factor
+        self._set_values(values, self._bin_names,
+                         fill_value=self._fill_value,
+                         bin_index=self._bin_index)
+
+    def scale_bin_patches(self, patches, factors, chunk_size=1000):
+        """Scale the submatrix of the bins of each patch (positions) by
+        its factor in place, like scale_bins for one patch after the
+        other. Patches that share no bin with another patch are scaled
+        together in one step with a factor and a patch number per bin:
+        a pair of bins is scaled by the factor of its first bin if both
+        bins belong to the same patch. Dense matrices are updated block
+        by block of chunk_size rows and packed matrices row by row, so
+        no array of the size of the matrix is built. Overlapping patches
+        are scaled one after the other.
+        """
+        number_of_bins = self.number_of_bins
+        patches = [np.arange(number_of_bins)[positions]
+                   for positions in patches]
+        memberships = np.bincount(
+            np.concatenate([np.zeros(0, dtype=np.int64)] + patches),
+            minlength=number_of_bins)
+        overlapping = [np.any(memberships[positions] > 1)
+                       for positions in patches]
+        patch_numbers = np.full(number_of_bins, -1, dtype=np.int64)
+        bin_factors = np.ones(number_of_bins, dtype=functools.reduce(
+            np.result_type, factors, self._values.dtype))
+        for patch_number, (positions, factor, is_overlapping) in enumerate(
+                zip(patches, factors, overlapping)):
+            if not is_overlapping:
+                patch_numbers[positions] = patch_number
+                bin_factors[positions] = factor
+        values = self._scalable_values(bin_factors)
+        # Bins without patch have the factor 1, so only the rows of bins
+        # in a patch are changed
+        if self.is_sparse():
+            rows = np.repeat(np.arange(number_of_bins),
+                             np.diff(values.indptr))
+            values.data *= np.where(
+                patch_numbers[rows] == patch_numbers[values.indices],
+                bin_factors[rows], 1)
+        elif self.is_packed():
+            offsets = packed_row_offsets(number_of_bins)
+            for row in np.flatnonzero(patch_numbers >= 0):
+                row_values = values[offsets[row]:
+                                    offsets[row] + number_of_bins - row]
+                row_values *= np.where(
+                    patch_numbers[row:] == patch_numbers[row],
+                    bin_factors[row], 1)
+        else:
+            for start in range(0, number_of_bins, chunk_size):
+                end = min(start + chunk_size, number_of_bins)
+                if np.all(patch_numbers[start:end] < 0):
+                    continue
+                values[start:end] *= np.where(
+                    patch_numbers[start:end, None] == patch_numbers[None, :],
+                    bin_factors[start:end, None], 1)
+        self._set_values(values, self._bin_names,
+                         fill_value=self._fill_value,
+                         bin_index=self._bin_index)
+        for positions, factor, is_overlapping in zip(
+                patches, factors, overlapping):
+            if is_overlapping:
+                self.scale_bins(positions, factor)
+
+    def _scalable_values(self, factor):
+        """Return the values converted to the data type of their product
+        with factor (a number or an array).
+        """
+        if self.is_sparse() and self._fill_value != 0:
+            sys.stderr.write("Only sparse matrices with fill value 0 "
+                             "can be scaled.\n")
+            sys.exit(1)
+        values = self._values
+        value_dtype = np.result_type(values.dtype, factor)
+        if value_dtype != values.dtype:
+            values = values.astype(value_dtype)
+            if self._dtype is not None:
+                self._dtype = value_dtype
+        return values
+
+    def observed_over_expected(self, inplace=False, chunk_size=1000):
+        """Divide each value by its expected value. The expected value of
+        a pair of bins of the same chromosome is the mean of the
+        diagonal of the chromosome block the pair is on, i.e. the mean
+        counting of all pairs of the chromosome with the same distance.
+        For pairs of different chromosomes it is the mean of all
+        inter-chromosomal values. Values with an expected value of 0
+        become 0.
+
+        Dense and packed matrices are divided block by block of
+        chunk_size rows, sparse matrices (with fill value 0) only at the
+        stored values. With inplace=True the values are replaced without
+        a copy unless they are integers (which become float64).
+        """
+        if not self.bin_index.is_contiguous:
+            sys.stderr.write("The bins of each chromosome have to be "
+                             "contiguous to calculate expected values.\n")
+            sys.exit(1)
+        if self.is_sparse() and self._fill_value != 0:
+            sys.stderr.write("Only sparse matrices with fill value 0 "
+                             "can be divided by their expected values.\n")
+            sys.exit(1)
+        values = self._values
+        if inplace:
+            hic_matrix = self
+        else:
+            hic_matrix = HiCMatrix(
+                values=values.copy(), bin_names=self._bin_names,
+                fill_value=self._fill_value, bin_index=self._bin_index,
+                dtype=self._dtype)
+        hic_matrix._divide_by_expected(chunk_size)
+        if not inplace:
+            return hic_matrix
+
+    def _divide_by_expected(self, chunk_size):
+        values = self._values
+        value_dtype = np.result_type(values.dtype, np.float32)
+        if value_dtype != values.dtype:
+            values = values.astype(value_dtype)
+            if self._dtype is not None:
+                self._dtype = value_dtype
+        number_of_bins = self.number_of_bins
+        if self.is_sparse():
+            cis_expected, trans_expected = self._sparse_expected()
+            rows = np.repeat(np.arange(number_of_bins),
+                             np.diff(values.indptr))
+            values.data[:] = divide_by_expected(
+                values.data, cell_expected(
+                    rows, values.indices, self.bin_index, cis_expected,
+                    trans_expected))
+        else:
+            cis_expected, trans_expected = expected_of_row_blocks(
+                self._dense_row_blocks(chunk_size), self.bin_index)
+            offsets = packed_row_offsets(number_of_bins)
+            for start in range(0, number_of_bins, chunk_size):
+                end = min(start + chunk_size, number_of_bins)
+                expected = cell_expected(
+                    np.arange(start, end)[:, None],
+                    np.arange(number_of_bins)[None, :], self.bin_index,
+                    cis_expected, trans_expected)
+                if not self.is_packed():
+                    values[start:end] = divide_by_expected(
+                        values[start:end], expected)
+                    continue
+                for row in range(start, end):
+                    row_values = values[offsets[row]:
+                                        offsets[row] + number_of_bins - row]
+                    row_values[:] = divide_by_expected(
+                        row_values, expected[row - start, row:])
+        self._set_values(values, self._bin_names,
+                         fill_value=self._fill_value,
+                         bin_index=self._bin_index)
+
+    def _sparse_expected(self):
+        """Expected values (see expected_of_row_blocks) from the stored
+        values of the upper triangle.
+        """
+        upper = self._values.tocoo()
+        chrom_codes = self.bin_index.chrom_codes
+        cis = chrom_codes[upper.row] == chrom_codes[upper.col]
+        chrom_sizes = np.diff(self.bin_index.offsets)
+        # The diagonals of each chromosome one after the other
+        diagonal_offsets = np.concatenate(([0], np.cumsum(chrom_sizes)))
+        diagonal_sums = np.bincount(
+            diagonal_offsets[chrom_codes[upper.row[cis]]] +
+            upper.col[cis] - upper.row[cis], weights=upper.data[cis],
+            minlength=diagonal_offsets[-1])
+        cis_expected = [
+            diagonal_sums[diagonal_offsets[code]:diagonal_offsets[code + 1]]
+            / np.arange(size, 0, -1)
+            for code, size in enumerate(chrom_sizes)]
+        # Each inter-chromosomal value is stored once for both directions
+        trans_sum = 2 * np.sum(upper.data[~cis], dtype=np.float64)
+        return cis_expected, _trans_mean(trans_sum, chrom_sizes)
 
     def div_by(self, denominator_matrix, pseudocount=0.001, inplace=False):
+        values, fill_value = self._div_by(
+            denominator_matrix, pseudocount=pseudocount)
         if inplace:
-            self.hic_matrix_df = self._div_by(
-                denominator_matrix, pseudocount=pseudocount)
+            self._set_values(values, self._bin_names, fill_value=fill_value)
         else:
-            return HiCMatrix(hic_matrix_df=self._div_by(
-                denominator_matrix, pseudocount=pseudocount))
+            return HiCMatrix(values=values, bin_names=self._bin_names,
+                             fill_value=fill_value, bin_index=self._bin_index,
+                             dtype=self._dtype)
 
-    def _div_by(self, denominator_matrix, pseudocount) -> pd.DataFrame:
+    def _div_by(self, denominator_matrix, pseudocount):
         """
         Add pseudocount first and then normalize to make sure that
         column sums are the same.
+
+        Returns the values and the fill value of the result.
         """
-        numerator_matrix_values = self.matrix_values() + pseudocount
-        denominator_matrix_values = denominator_matrix.matrix_values() + pseudocount
-        diff_matrix = numerator_matrix_values / denominator_matrix_values
-        return pd.concat([self.hic_matrix_df[[
-            "HiCMatrix", "Regions"]], diff_matrix],
-                         axis=1, ignore_index=True)
+        if self.is_sparse() and denominator_matrix.is_sparse():
+            return self._div_by_sparse(denominator_matrix, pseudocount)
+        if self.is_packed() and denominator_matrix.is_packed():
+            return ((self._values + pseudocount) /
+                    (denominator_matrix._values + pseudocount)), 0.0
+        numerator_matrix_values = self._dense_values() + pseudocount
+        denominator_matrix_values = (
+            denominator_matrix._dense_values() + pseudocount)
+        return numerator_matrix_values / denominator_matrix_values, 0.0
+
+    def _div_by_sparse(self, denominator_matrix, pseudocount):
+        """Only the cells stored in at least one of the two matrices are
+        calculated. All other cells share the ratio of the fill values,
+        which becomes the fill value of the result.
+        """
+        numerator_upper = self._values
+        denominator_upper = denominator_matrix._values
+        with np.errstate(divide="ignore", invalid="ignore"):
+            fill_value = ((self._fill_value + pseudocount) /
+                          (denominator_matrix._fill_value + pseudocount))
+            union = (abs(numerator_upper) + abs(denominator_upper)).tocoo()
+            numerator = np.asarray(numerator_upper[
+                union.row, union.col]).ravel() + self._fill_value
+            denominator = np.asarray(denominator_upper[
+                union.row, union.col]).ravel() + (
+                    denominator_matrix._fill_value)
+            ratios = ((numerator + pseudocount) /
+                      (denominator + pseudocount)) - fill_value
+        return sparse.csr_matrix(
+            (ratios, (union.row, union.col)), shape=union.shape), fill_value
 
     def heatmap(self, vmin=None, vmax=None, output_prefix=None,
                 by_chrom=False, rotate=False, output_pdf=False,output_png=False, png_dpi=600,
@@ -172,8 +843,19 @@ class HiCMatrix:
             self._pp.close()
 
     def matrix_values(self):
-        """Return the matrix without the bin name columns.
+        """Return the matrix without the bin name columns. Sparse
+        matrices are returned as pandas sparse DataFrame.
         """
+        if self.is_sparse():
+            symmetric_values = self._symmetric_values().tocsc()
+            sparse_matrix_values = pd.DataFrame({
+                bin_name: pd.arrays.SparseArray.from_spmatrix(
+                    symmetric_values[:, [column]])
+                for column, bin_name in enumerate(self._bin_names)})
+            if self._fill_value != 0:
+                sparse_matrix_values = (
+                    sparse_matrix_values + self._fill_value)
+            return sparse_matrix_values
         return self.hic_matrix_df.iloc[0:, 2:]
 
     def alt_matrix_values(self):
@@ -190,12 +872,10 @@ class HiCMatrix:
             self._write_iHMs_to_file()
 
     def _plot_heatmap_split_by_chrom(self):
-        chroms = sorted(set(["-".join(genome_bin.split("-")[:-1])
-            for genome_bin in self.alt_matrix_values().columns]))
-        for chrom in chroms:
-            chrom_hic_matrix = self.select(keep_pattern=chrom)
+        for chrom in self.chromosomes:
+            chrom_hic_matrix = self.select_region(chrom)
             # Make sure that at lest 2 bin are in the submatrix
-            if chrom_hic_matrix.hic_matrix_df.shape[0] < 2:
+            if chrom_hic_matrix.number_of_bins < 2:
                 print(f"Skipping {chrom} as the number of bins is too low.")
                 continue
             self._plot_heatmap(chrom_hic_matrix, title=chrom)
@@ -203,13 +883,18 @@ class HiCMatrix:
             self._write_iHMs_to_file()
 
     def _plot_heatmap(self, hic_matrix, title=""):
+        # The plotting libraries are imported here as importing them takes
+        # several seconds, which is not needed for all other subcommands
+        from scipy import ndimage
+        plt = _pyplot()
+        import seaborn as sns
         matrix_values = hic_matrix.alt_matrix_values()
         if self._rotate:
             matrix_values = ndimage.rotate(matrix_values.to_numpy(), 45.0)
             matrix_values = matrix_values[:int(matrix_values.shape[0] / 2), :]
             # matrix_values = pd.DataFrame(data=matrix_values)
         if self._vmin is None:
-            self._vmin = min(self.alt_matrix_values().min())
+            self._vmin = self._min_value()
         cmap = sns.cubehelix_palette(n_colors=500)
         if self._differential:
             cmap = sns.color_palette("RdBu_r", 500)
@@ -227,7 +912,15 @@ class HiCMatrix:
         if self._interactive_plot:
             self._plot_interactive_heatmap(matrix_values, title)
 
+    def _min_value(self):
+        if self._lazy and self._is_cooler():
+            return cooler_min_value(self._hic_matrix_file)
+        if self._lazy and self._row_index is not None:
+            return self._row_index.min_value()
+        return min(self.alt_matrix_values().min())
+
     def _plot_interactive_heatmap(self, matrix_values, title=""):
+        hv = _holoviews()
         data_list = self._flatten_matrix_to_tuple_list(matrix_values)
         self._iHMs.append(hv.HeatMap(data_list, label=title,
                         kdims=["Bin-X", "Bin-Y"],
@@ -263,6 +956,7 @@ class HiCMatrix:
     def _write_heatmap_to_file(self, heatmap, title=""):
         if self._output_pdf:
             if self._pp is None:
+                from matplotlib.backends.backend_pdf import PdfPages
                 self._pp = PdfPages(f"{self._output_prefix}.pdf")
             self._pp.savefig(heatmap.figure)
         if self._output_png:
@@ -284,7 +978,7 @@ class HiCMatrix:
                 plots = hm
             else:
                 plots = plots + hm
-        hv.save(plots, f'{self._output_prefix}.html')
+        _holoviews().save(plots, f'{self._output_prefix}.html')
 
     def calc_distance_dependent_decay(self, bin_size=None):
         if bin_size is None:
@@ -315,54 +1009,644 @@ class HiCMatrix:
 
         # Generate submatrix for this chromosome as only
         # intra-chromosomal interactions should be considered
-        submatrix = self.select(keep_pattern=chrom)
-        seen_pairs = set()
-        col_counter = 0
-        self._chroms_dists_and_countings[chrom] = {}
-        self._chroms_dists_and_countings[chrom]["dists"] = np.array([])
-        self._chroms_dists_and_countings[chrom]["countings"] = np.array([])
-        for col_bin in submatrix.alt_matrix_values():
-            col_counter += 1
-            row_counter = 0
-            for counting, row_bin in zip(
-                    submatrix.hic_matrix_df[col_bin],
-                    submatrix.hic_matrix_df["Regions"]):
-                row_counter += 1
-                bin_pair = tuple(sorted([row_bin, col_bin]))
-                # Skip bin pair comparison measured before
-                if bin_pair in seen_pairs:
-                    continue
-                seen_pairs.add(bin_pair)
-                # Calculate the distance between the two considered bins
-                dist = abs(row_counter - col_counter) * bin_size
-                self._chroms_dists_and_countings[chrom]["dists"] = np.append(
-                    self._chroms_dists_and_countings[chrom]["dists"], dist)
-                self._chroms_dists_and_countings[chrom][
-                    "countings"] = np.append(
-                        self._chroms_dists_and_countings[chrom]["countings"],
-                        counting)
+        submatrix = self.select_region(chrom)
+        self._chroms_dists_and_countings[chrom] = (
+            submatrix._get_diagonal_dists_and_countings(bin_size))
+
+    def _get_diagonal_dists_and_countings(self, bin_size):
+        """Each bin (column) is compared to itself and the following bins
+        (rows), i.e. the pairs are ordered by the first bin and the
+        distance. The countings of one distance are taken at once from
+        a diagonal and scattered into arrays allocated for all pairs.
+        """
+        number_of_bins = self.number_of_bins
+        first_pairs = packed_row_offsets(number_of_bins)
+        number_of_pairs = number_of_bins * (number_of_bins + 1) // 2
+        dists = np.empty(number_of_pairs)
+        countings = np.empty(number_of_pairs)
+        for offset, diagonal in self.iter_diagonals():
+            pairs = first_pairs[:number_of_bins - offset] + offset
+            dists[pairs] = offset * bin_size
+            countings[pairs] = diagonal
+        return {"dists": dists, "countings": countings}
+
+    def iter_diagonals(self):
+        """Yield the offset and the values of each diagonal, i.e. of the
+        pairs of each bin with the bin offset bins further, ordered by
+        the first bin. Only one diagonal is built at a time. For dense
+        matrices the diagonals below the main diagonal are used.
+        """
+        number_of_bins = self.number_of_bins
+        values = self._values
+        if self.is_sparse():
+            upper = values.tocoo()
+            cell_offsets = upper.col - upper.row
+            order = np.argsort(cell_offsets, kind="stable")
+            diagonal_starts = np.searchsorted(
+                cell_offsets[order], np.arange(number_of_bins + 1))
+            value_dtype = np.result_type(upper.dtype, self._fill_value)
+        elif self.is_packed():
+            first_pairs = packed_row_offsets(number_of_bins)
+        for offset in range(number_of_bins):
+            if self.is_sparse():
+                diagonal = np.full(number_of_bins - offset, self._fill_value,
+                                   dtype=value_dtype)
+                cells = order[diagonal_starts[offset]:
+                              diagonal_starts[offset + 1]]
+                diagonal[upper.row[cells]] += upper.data[cells]
+            elif self.is_packed():
+                diagonal = values[first_pairs[:number_of_bins - offset] +
+                                  offset]
+            else:
+                diagonal = np.diagonal(values, offset=-offset)
+            yield offset, diagonal
+
+    def upper_triangle(self, nonzero=False):
+        """Return the rows, the columns and the values of all cells of the
+        upper triangle (incl. the diagonal) row by row, i.e. of each pair
+        of bins exactly once. For packed matrices the values are the
+        stored array itself.
+
+        With nonzero=True only the cells with a nonzero value are
+        returned. For sparse matrices (with fill value 0) they are taken
+        from the stored values without generating all cells.
+        """
+        if nonzero:
+            if self.is_sparse() and self._fill_value == 0:
+                upper = self._values.tocoo()
+                order = np.lexsort((upper.col, upper.row))
+                rows, cols, values = (
+                    upper.row[order], upper.col[order], upper.data[order])
+            else:
+                rows, cols, values = self.upper_triangle()
+            nonzero_cells = values != 0
+            return (rows[nonzero_cells], cols[nonzero_cells],
+                    values[nonzero_cells])
+        rows, cols = np.triu_indices(self.number_of_bins)
+        if self.is_packed():
+            return rows, cols, self._values
+        if self.is_sparse():
+            upper = self._values.tocoo()
+            values = np.full(len(rows), self._fill_value,
+                             dtype=np.result_type(upper.dtype,
+                                                  self._fill_value))
+            values[packed_row_offsets(self.number_of_bins)[upper.row]
+                   + upper.col - upper.row] += upper.data
+            return rows, cols, values
+        return rows, cols, self._values[rows, cols]
+
+    def coarsen(self, factor, inplace=False, chunk_size=1000):
+        """Merge each factor consecutive bins of a chromosome into one bin
+        (the last bin of a chromosome can contain less bins) and sum up
+        their values. The new bins are named after their first bin. The
+        result is stored like the values of this matrix (dense, sparse
+        or packed).
+        """
+        (values, bin_names, bin_index), = coarsen_row_blocks(
+            self._dense_row_blocks(chunk_size), self.bin_index, [factor])
+        if self.is_sparse():
+            values = sparse_upper_triangle(values)
+        elif self.is_packed():
+            values = pack_upper_triangle(values)
+        if inplace:
+            self._set_values(values, bin_names, bin_index=bin_index)
+        else:
+            return HiCMatrix(values=values, bin_names=bin_names,
+                             bin_index=bin_index, dtype=self._dtype)
 
     def histogram(self, output_prefix=None):
-        matrix = self.alt_matrix_values()
-        reads_list = []
-        for i in self._flatten_matrix_to_tuple_list(matrix, distinct=True):
-            reads_list.append(i[2])
-        fig = sns.distplot(reads_list, axlabel="reads", hist=True, kde=False)
+        """Plot the distribution of the values of all pairs of bins (each
+        pair counted once).
+        """
+        _pyplot()
+        import seaborn as sns
+        rows, cols, reads = self.upper_triangle()
+        fig = sns.distplot(reads, axlabel="reads", hist=True, kde=False)
         fig.figure.savefig(f"{output_prefix}.png", dpi=1200)
 
 
-def remove_position_information(name_with_pos_info: str):
-    # Return just the chromosome part without the exact window
-    # location
-    return "-".join(name_with_pos_info.split("-")[:-1])
+def _pyplot():
+    import matplotlib
+    matplotlib.use("Agg")
+    import matplotlib.pyplot as plt
+    return plt
+
+
+def _holoviews():
+    import holoviews as hv
+    hv.extension('bokeh')
+    return hv
+
+
+def packed_row_offsets(number_of_bins):
+    """Return the position of the diagonal cell of each row in the packed
+    upper triangle.
+    """
+    rows = np.arange(number_of_bins, dtype=np.int64)
+    return rows * number_of_bins - rows * (rows - 1) // 2
+
+
+def pack_upper_triangle(values):
+    """Convert a dense symmetric matrix into the one-dimensional array
+    of its upper triangle (incl. the diagonal), row by row.
+    """
+    number_of_bins = values.shape[0]
+    packed_values = np.empty(number_of_bins * (number_of_bins + 1) // 2,
+                             dtype=values.dtype)
+    for row, offset in enumerate(packed_row_offsets(number_of_bins)):
+        packed_values[offset:offset + number_of_bins - row] = values[
+            row, row:]
+    return packed_values
+
+
+def upper_triangle_values(upper, sparse=False, packed=False):
+    """Convert a CSR matrix of the upper triangle (incl. the diagonal)
+    into the values of a HiCMatrix - kept sparse, packed or dense.
+    """
+    if sparse:
+        return upper
+    if packed:
+        upper = upper.tocoo()
+        packed_values = np.zeros(upper.shape[0] * (upper.shape[0] + 1) // 2,
+                                 dtype=upper.dtype)
+        packed_values[packed_row_offsets(upper.shape[0])[upper.row]
+                      + upper.col - upper.row] = upper.data
+        return packed_values
+    # Same memory layout as the values read from Homer files so that
+    # the column sums are added up in the same order
+    values = upper.toarray(order="F")
+    rows, cols = np.nonzero(np.triu(values, k=1))
+    values[cols, rows] = values[rows, cols]
+    return values
+
+
+def sparse_upper_triangle(values):
+    """Convert a dense symmetric matrix into a CSR matrix of its upper
+    triangle (incl. the diagonal).
+    """
+    return sparse.csr_matrix(np.triu(values))
+
+
+def coarse_bins(bin_index, factor):
+    """Return the position of the first bin of each coarse bin (factor
+    consecutive bins of a chromosome) together with the names and the
+    index of the coarse bins.
+    """
+    if not bin_index.is_contiguous:
+        sys.stderr.write("The bins of each chromosome have to be "
+                         "contiguous to coarsen a matrix.\n")
+        sys.exit(1)
+    group_starts = np.concatenate([
+        np.arange(chrom_start, chrom_end, factor) for chrom_start, chrom_end
+        in zip(bin_index.offsets[:-1], bin_index.offsets[1:])]).astype(
+            np.int64)
+    chroms = bin_index.chroms()[group_starts]
+    starts = bin_index.starts[group_starts]
+    bin_names = (pd.Series(chroms, dtype=object) + "-" +
+                 pd.Series(starts).astype(str)).to_numpy(dtype=object)
+    return group_starts, bin_names, BinIndex(chroms=chroms, starts=starts)
+
+
+def coarsen_row_blocks(row_blocks, bin_index, factors):
+    """Coarsen a matrix given as blocks of dense rows (first row, values)
+    by all factors in one pass over the blocks. Returns the values,
+    names and index of the bins for each factor. The values are summed
+    up with numpy.add.reduceat over the columns and rows of the coarse
+    bins. Integer values are summed up as int64.
+    """
+    levels = []
+    for factor in factors:
+        group_starts, bin_names, coarse_bin_index = coarse_bins(
+            bin_index, factor)
+        bin_groups = np.repeat(np.arange(len(group_starts)), np.diff(
+            np.append(group_starts, len(bin_index))))
+        levels.append([group_starts, bin_groups, None, bin_names,
+                       coarse_bin_index])
+    for first_row, values in row_blocks:
+        if values.shape[0] == 0:
+            continue
+        if np.issubdtype(values.dtype, np.integer):
+            values = values.astype(np.int64)
+        for level in levels:
+            group_starts, bin_groups = level[0], level[1]
+            if level[2] is None:
+                level[2] = np.zeros((len(group_starts), len(group_starts)),
+                                    dtype=values.dtype)
+            block_groups = bin_groups[first_row:first_row + values.shape[0]]
+            # The rows of a block can belong to several coarse bins and a
+            # coarse bin can span several blocks
+            row_starts = np.flatnonzero(np.diff(block_groups, prepend=-1))
+            level[2][block_groups[row_starts]] += np.add.reduceat(
+                np.add.reduceat(values, group_starts, axis=1),
+                row_starts, axis=0)
+    return [(coarse_values, bin_names, coarse_bin_index)
+            for _, _, coarse_values, bin_names, coarse_bin_index in levels]
+
+
+def coarsen_hic_matrix_file(input_file: str, output_file: str, factors,
+                            chunk_size=1000, dtype=None):
+    """Coarsen a matrix file by several factors in one pass over the
+    file. Homer files are read block by block of rows, cooler files are
+    read as sparse matrix. Each level is written into the multi-resolution
+    cooler file output_file as resolutions/<bin size> so that the other
+    subcommands can pick a level (e.g. output.mcool::resolutions/50000).
+    A single factor can also be written to a Homer or .cool file.
+    """
+    if len(factors) > 1 and not output_file.endswith(".mcool"):
+        sys.stderr.write("Several factors can only be written into a "
+                         ".mcool file.\n")
+        sys.exit(1)
+    hic_matrix = read_hic_matrix(input_file, lazy=True, sparse=True,
+                                 dtype=dtype)
+    if is_cooler_file(input_file):
+        row_blocks = hic_matrix._dense_row_blocks(chunk_size)
+    else:
+        row_blocks = _numbered_row_blocks(iter_homer_row_blocks(
+            input_file, chunk_size=chunk_size, dtype=dtype))
+    for values, bin_names, bin_index in coarsen_row_blocks(
+            row_blocks, hic_matrix.bin_index, factors):
+        HiCMatrix(values=values, bin_names=bin_names, bin_index=bin_index,
+                  dtype=dtype).save(output_file, chunk_size=chunk_size)
+
+
+def _numbered_row_blocks(row_blocks):
+    """Add the first row to blocks of (bin names, values).
+    """
+    first_row = 0
+    for bin_names, values in row_blocks:
+        yield first_row, values
+        first_row += values.shape[0]
+
+
+def read_hic_matrix(input_file: str, use_cache=False, sparse=False,
+                    lazy=False, dtype=None, packed=False, row_index=False):
+    """Read a matrix in Homer format. With use_cache=True a binary copy
+    of the values is stored next to the input file on first load and
+    memory-mapped on all following loads as long as the size and the
+    modification time of the input file are unchanged. If the directory
+    of the input file is not writable the matrix is read without cache.
+    Sparse and packed matrices are always read from the Homer file.
+
+    With lazy=True only the bin names are read (from the header or the
+    binary cache) and no binary cache is created.
+
+    For each dtype a separate binary cache is kept.
+
+    With row_index=True the matrix is read lazily together with the row
+    index of the file (which is built on first use). select_region then
+    reads only the rows of the requested regions.
+
+    Cooler files (.cool/.mcool) are indexed by themselves. They are
+    always read lazily and without binary cache.
+
+    Matrix files can be compressed (.gz or .zst). The row index needs
+    an uncompressed file, so it is not used for compressed files.
+    """
+    if is_cooler_file(input_file):
+        return HiCMatrix(hic_matrix_file=input_file, sparse=sparse,
+                         packed=packed, lazy=True, dtype=dtype)
+    if row_index and is_compressed(input_file):
+        sys.stderr.write(f"No row index for the compressed file "
+                         f"{input_file}. Reading the whole matrix.\n")
+        row_index = False
+    if row_index:
+        return HiCMatrix(hic_matrix_file=input_file, lazy=True, dtype=dtype,
+                         row_index=get_row_index(input_file))
+    if sparse or packed:
+        return HiCMatrix(hic_matrix_file=input_file, sparse=sparse,
+                         packed=packed, lazy=lazy, dtype=dtype)
+    if use_cache and binary_cache_is_current(input_file, dtype=dtype):
+        return read_binary_cache(input_file, dtype=dtype)
+    if lazy or not use_cache:
+        return HiCMatrix(hic_matrix_file=input_file, lazy=lazy, dtype=dtype)
+    source_signature = _source_signature(input_file)
+    hic_matrix = HiCMatrix(hic_matrix_file=input_file, dtype=dtype)
+    if len(bin_names_without_start(hic_matrix.bins())) > 0:
+        # The cache stores the chromosome and start of each bin
+        sys.stderr.write(f"No binary cache for {input_file} as its bin "
+                         "names have no start positions.\n")
+        return hic_matrix
+    if not os.access(os.path.dirname(os.path.abspath(input_file)),
+                     os.W_OK):
+        sys.stderr.write(f"No binary cache for {input_file} as its "
+                         "directory is not writable.\n")
+        return hic_matrix
+    try:
+        write_binary_cache(hic_matrix, input_file, dtype=dtype,
+                           source_signature=source_signature)
+    except OSError as error:
+        sys.stderr.write(f"Could not write binary cache of {input_file}: "
+                         f"{error}\n")
+    return hic_matrix
+
+
+def write_homer_header(output_fh, bin_names):
+    output_fh.write("\t".join(
+        ["HiCMatrix", "Regions"] + list(bin_names)) + "\n")
+
+
+def write_homer_rows(output_fh, values, bin_names):
+    """Write a block of rows (values of the bins x all bins) in Homer
+    format.
+    """
+    chunk = pd.DataFrame(values, copy=False)
+    chunk.insert(0, "Regions", bin_names)
+    chunk.insert(0, "HiCMatrix", bin_names)
+    chunk.to_csv(output_fh, sep="\t", index=False, header=False)
+
+
+def read_homer_chunks(input_file: str, chunk_size=1000, dtype=None):
+    """Read a (compressed) matrix file in Homer format as DataFrames of
+    chunk_size rows.
+    """
+    with open_file(input_file, "rb") as matrix_fh:
+        yield from pd.read_csv(matrix_fh, sep="\t", dtype=dtype,
+                               chunksize=chunk_size)
+
+
+def iter_homer_row_blocks(input_file: str, chunk_size=1000, dtype=None):
+    """Read a matrix in Homer format block by block. Yields the bin
+    names of the rows and their values as array.
+    """
+    hic_matrix = HiCMatrix(hic_matrix_file=input_file, lazy=True,
+                           dtype=dtype)
+    first_row = 0
+    for chunk in read_homer_chunks(input_file, chunk_size,
+                                   hic_matrix._csv_dtypes()):
+        first_row += chunk.shape[0]
+        yield (chunk["Regions"].to_numpy(dtype=object),
+               chunk.iloc[0:, 2:].to_numpy(dtype=hic_matrix._dtype))
+    if first_row != hic_matrix.number_of_bins:
+        sys.stderr.write("Unexpected ratio of columns and rows."
+                         "Is this really a HiC matrix in Homer format?")
+        sys.exit(1)
+
+
+def column_sum_median_of_file(input_file: str, chunk_size=1000,
+                              dtype=None):
+    """Same as HiCMatrix._calc_column_sum_median but only one block of
+    rows is held in memory. The sums of the blocks are added up, so for
+    files with more than chunk_size rows the result can differ in the
+    last digits.
+    """
+    column_sums = None
+    for bin_names, values in iter_homer_row_blocks(
+            input_file, chunk_size=chunk_size, dtype=dtype):
+        if column_sums is not None:
+            values = np.vstack((column_sums, values))
+        column_sums = np.nansum(values, axis=0)
+    column_sum_median = np.median(column_sums)
+    if dtype is not None:
+        column_sum_median = np.dtype(dtype).type(column_sum_median)
+    return column_sum_median
+
+
+def div_hic_matrix_files(numerator_file: str, denominator_file: str,
+                         output_file: str, pseudocount=0.001,
+                         norm_by_col_sum=False, chunk_size=1000,
+                         dtype=None):
+    """Streaming version of HiCMatrix.div_by for two matrices in Homer
+    format. Both files are read block by block of rows in lockstep and
+    the ratios are written directly, so the memory usage depends on the
+    chunk size but not on the size of the matrices. With norm_by_col_sum
+    both matrices are normalized by their column sum median first (which
+    requires one additional pass over each file).
+
+    The result is identical to reading both matrices, normalizing them,
+    dividing them and saving the result (apart from rounding differences
+    of the column sums, see column_sum_median_of_file).
+    """
+    for matrix_file in (numerator_file, denominator_file, output_file):
+        if is_cooler_file(matrix_file):
+            sys.stderr.write(f"The cooler file {matrix_file} can not be "
+                             "streamed. Please omit --streaming.\n")
+            sys.exit(1)
+    numerator_factor, denominator_factor = 1, 1
+    if norm_by_col_sum:
+        numerator_factor = column_sum_median_of_file(
+            numerator_file, chunk_size=chunk_size, dtype=dtype)
+        denominator_factor = column_sum_median_of_file(
+            denominator_file, chunk_size=chunk_size, dtype=dtype)
+    bin_names = HiCMatrix(hic_matrix_file=numerator_file, lazy=True)._bin_names
+    denominator_bin_names = HiCMatrix(
+        hic_matrix_file=denominator_file, lazy=True)._bin_names
+    if not np.array_equal(bin_names, denominator_bin_names):
+        sys.stderr.write("The bins of the numerator and the denominator "
+                         "matrix differ.\n")
+        sys.exit(1)
+    with open_file(output_file, "w") as output_fh:
+        write_homer_header(output_fh, bin_names)
+        for (row_bin_names, numerator_values), (
+                denominator_row_bin_names, denominator_values) in zip(
+                    iter_homer_row_blocks(numerator_file, chunk_size, dtype),
+                    iter_homer_row_blocks(
+                        denominator_file, chunk_size, dtype)):
+            if not np.array_equal(row_bin_names, denominator_row_bin_names):
+                sys.stderr.write("The bins of the numerator and the "
+                                 "denominator matrix differ.\n")
+                sys.exit(1)
+            if norm_by_col_sum:
+                numerator_values = numerator_values / numerator_factor
+                denominator_values = (
+                    denominator_values / denominator_factor)
+            write_homer_rows(
+                output_fh,
+                (numerator_values + pseudocount) /
+                (denominator_values + pseudocount),
+                row_bin_names)
+
+
+def expected_of_row_blocks(row_blocks, bin_index):
+    """Return the expected values of the matrix given as blocks of rows
+    (first row, dense values). For each chromosome (in the order of
+    bin_index.chrom_names) the mean of each diagonal of its block, from
+    the main diagonal on, and the mean of all inter-chromosomal values.
+    The diagonals are summed up from the upper triangle of the blocks.
+    """
+    chrom_sizes = np.diff(bin_index.offsets)
+    diagonal_sums = [np.zeros(size) for size in chrom_sizes]
+    trans_sum = 0.0
+    for first_row, values in row_blocks:
+        end_row = first_row + values.shape[0]
+        trans_sum += np.sum(values, dtype=np.float64)
+        for code, size in enumerate(chrom_sizes):
+            chrom_start = bin_index.offsets[code]
+            start = max(first_row, chrom_start)
+            end = min(end_row, chrom_start + size)
+            if start >= end:
+                continue
+            block = values[start - first_row:end - first_row,
+                           chrom_start:chrom_start + size]
+            trans_sum -= np.sum(block, dtype=np.float64)
+            diagonals = (np.arange(size)[None, :] -
+                         np.arange(start - chrom_start,
+                                   end - chrom_start)[:, None])
+            upper = diagonals >= 0
+            diagonal_sums[code] += np.bincount(
+                diagonals[upper], weights=block[upper], minlength=size)
+    cis_expected = [sums / np.arange(len(sums), 0, -1)
+                    for sums in diagonal_sums]
+    return cis_expected, _trans_mean(trans_sum, chrom_sizes)
+
+
+def _trans_mean(trans_sum, chrom_sizes):
+    number_of_bins = np.sum(chrom_sizes)
+    number_of_trans_pairs = number_of_bins ** 2 - np.sum(chrom_sizes ** 2)
+    if number_of_trans_pairs == 0:
+        return 0.0
+    return trans_sum / number_of_trans_pairs
+
+
+def cell_expected(rows, cols, bin_index, cis_expected, trans_expected):
+    """Return the expected values of the cells given by (broadcastable)
+    arrays of rows and columns.
+    """
+    chrom_codes = bin_index.chrom_codes
+    row_codes = chrom_codes[rows]
+    # The expected values of all chromosomes one after the other
+    flat_offsets = np.concatenate(
+        ([0], np.cumsum([len(expected) for expected in cis_expected])))
+    flat_expected = np.concatenate(cis_expected + [[trans_expected]])
+    cis = row_codes == chrom_codes[cols]
+    return flat_expected[np.where(
+        cis, flat_offsets[row_codes] + np.abs(cols - rows), -1)]
+
+
+def divide_by_expected(values, expected):
+    return np.divide(values, expected, out=np.zeros(
+        np.broadcast(values, expected).shape), where=expected != 0)
+
+
+def observed_over_expected_of_file(input_file: str, output_file: str,
+                                   chunk_size=1000, dtype=None):
+    """Streaming version of HiCMatrix.observed_over_expected for
+    matrices in Homer format. The file is read twice block by block of
+    rows: once to calculate the expected values and once to divide the
+    rows by them and write them to output_file (in Homer format). Only
+    chunk_size rows are held in memory. The expected values can differ
+    from the ones of the whole matrix in the last digits as the sums are
+    added up block by block. Cooler files are not supported.
+    """
+    for matrix_file in (input_file, output_file):
+        if is_cooler_file(matrix_file):
+            sys.stderr.write(f"The cooler file {matrix_file} can not be "
+                             "streamed. Please omit --streaming.\n")
+            sys.exit(1)
+    hic_matrix = HiCMatrix(hic_matrix_file=input_file, lazy=True,
+                           dtype=dtype)
+    bin_index = hic_matrix.bin_index
+    if not bin_index.is_contiguous:
+        sys.stderr.write("The bins of each chromosome have to be "
+                         "contiguous to calculate expected values.\n")
+        sys.exit(1)
+    cis_expected, trans_expected = expected_of_row_blocks(
+        _numbered_row_blocks(iter_homer_row_blocks(
+            input_file, chunk_size=chunk_size, dtype=dtype)), bin_index)
+    all_cols = np.arange(hic_matrix.number_of_bins)[None, :]
+    with open_file(output_file, "w") as output_fh:
+        write_homer_header(output_fh, hic_matrix._bin_names)
+        for first_row, (row_bin_names, values) in zip(
+                range(0, hic_matrix.number_of_bins, chunk_size),
+                iter_homer_row_blocks(input_file, chunk_size, dtype)):
+            rows = np.arange(first_row, first_row + values.shape[0])
+            ratios = divide_by_expected(values, cell_expected(
+                rows[:, None], all_cols, bin_index, cis_expected,
+                trans_expected))
+            if dtype is not None:
+                ratios = ratios.astype(dtype)
+            write_homer_rows(output_fh, ratios, row_bin_names)
+
+
+def binary_cache_file(input_file: str, dtype=None):
+    """Return the path of the binary cache of the values, e.g.
+    matrix.txt.hicsd.npy or matrix.txt.float32.hicsd.npy.
+    """
+    if dtype is None:
+        return input_file + BINARY_CACHE_SUFFIX
+    return f"{input_file}.{np.dtype(dtype).name}{BINARY_CACHE_SUFFIX}"
+
+
+def _source_signature(input_file: str):
+    """Return the size and the modification time (in ns) of the matrix
+    file as line of the source file of the binary cache.
+    """
+    stat = os.stat(input_file)
+    return f"{stat.st_size}\t{stat.st_mtime_ns}\n"
+
+
+def binary_cache_is_current(input_file: str, dtype=None):
+    """The cache is only used if the matrix file has still the size and
+    modification time it had when the cache was written.
+    """
+    values_file = binary_cache_file(input_file, dtype)
+    source_file = values_file + SOURCE_CACHE_SUFFIX
+    for cache_file in [values_file, input_file + BINS_CACHE_SUFFIX,
+                       source_file]:
+        if not os.path.exists(cache_file):
+            return False
+    with open(source_file) as source_fh:
+        return source_fh.read() == _source_signature(input_file)
+
+
+def write_binary_cache(hic_matrix, input_file: str, dtype=None,
+                       source_signature=None):
+    """Write the values as .npy array and the bin names plus their
+    coordinates as tab separated sidecar file. The size and modification
+    time of the matrix file (by default the current ones) are written
+    into a third file (e.g. matrix.txt.hicsd.npy.source).
 
+    |-----------+-------+-------|
+    | bin       | chrom | start |
+    |-----------+-------+-------|
+    | chr1-0    | chr1  | 0     |
+    | chr1-1000 | chr1  | 1000  |
+    | ...       | ...   | ...   |
 
-def bin_number(name_with_pos_info: int):
-    return int(name_with_pos_info.split("-")[-1])
+    All files are written to temporary files first and then moved in
+    place so that an interrupted run never leaves a truncated cache. The
+    source file is moved last, so the cache is only used once it is
+    complete.
+    """
+    if source_signature is None:
+        source_signature = _source_signature(input_file)
+    bins = pd.DataFrame({"bin": hic_matrix.bins(),
+                         "chrom": hic_matrix.bin_index.chroms(),
+                         "start": hic_matrix.bin_index.starts})
+    values_file = binary_cache_file(input_file, dtype)
+    source_file = values_file + SOURCE_CACHE_SUFFIX
+    tmp_files = [values_file + ".tmp", input_file + BINS_CACHE_SUFFIX + ".tmp",
+                 source_file + ".tmp"]
+    try:
+        with open(tmp_files[0], "wb") as values_fh:
+            np.save(values_fh, hic_matrix.matrix_values().to_numpy())
+        bins.to_csv(tmp_files[1], sep="\t", index=False)
+        with open(tmp_files[2], "w") as source_fh:
+            source_fh.write(source_signature)
+    except OSError:
+        for tmp_file in tmp_files:
+            if os.path.exists(tmp_file):
+                os.remove(tmp_file)
+        raise
+    # Invalidate the old cache before its values are replaced
+    if os.path.exists(source_file):
+        os.remove(source_file)
+    for tmp_file, cache_file in zip(tmp_files, [
+            values_file, input_file + BINS_CACHE_SUFFIX, source_file]):
+        os.replace(tmp_file, cache_file)
 
 
-def read_hic_matrix(input_file: str):
-    return HiCMatrix(hic_matrix_file=input_file)
+def read_binary_cache(input_file: str, dtype=None):
+    """Memory-map the cached values. The mapping is copy-on-write so
+    in-place operations never modify the cache file and only the pages
+    that are touched are read from disk.
+    """
+    values = np.load(binary_cache_file(input_file, dtype), mmap_mode="c")
+    bins = pd.read_csv(input_file + BINS_CACHE_SUFFIX, sep="\t",
+                       dtype={"bin": str, "chrom": str})
+    return HiCMatrix(values=values, bin_names=bins["bin"],
+                     bin_index=BinIndex(chroms=bins["chrom"],
+                                        starts=bins["start"]),
+                     dtype=dtype)
 
 
 def MissingOutputFile(BaseException):
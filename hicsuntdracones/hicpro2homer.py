@@ -1,49 +1,287 @@
-from collections import defaultdict
+import sys
+import numpy as np
 import pandas as pd
+import scipy.sparse
+from hicsuntdracones.binindex import BinIndex
+from hicsuntdracones.compressedio import open_file
+from hicsuntdracones.coolerfile import is_cooler_file
+from hicsuntdracones.hicmatrix import HiCMatrix, upper_triangle_values
 
 
-def hicpro2homer(input_bed: str, input_matrix: str, output_matrix: str):
+def hicpro2homer(input_bed: str, input_matrix: str, output_matrix: str,
+                 streaming=False, chunk_size=1000000):
     """Converts HiC interaction matrices generated by HiC-Pro [1] into the
     format used by Homer [2]
 
-    This tool converts (iced) Hi-C matrices generated by HiC-Pro into the format of Homer. 
-    While the HiC-Pro matrix reports both directions of an interaction (a -> and b -> a), 
-    the Homer format is less redundant as it stores each interaction value of two bins under one ID. 
+    This tool converts (iced) Hi-C matrices generated by HiC-Pro into the format of Homer.
+    While the HiC-Pro matrix reports both directions of an interaction (a -> and b -> a),
+    the Homer format is less redundant as it stores each interaction value of two bins under one ID.
     The homer format also skips the report of zero value interactions.
 
+    The triplets are scattered into a symmetric array by the position of
+    their bins in the BED file and the array is written in one go. With
+    streaming=True the matrix is never held in memory completely, see
+    hicpro2homer_streaming. If the output file is a cooler file (.cool
+    or .mcool) the matrix is imported as sparse matrix (see
+    read_hic_pro) and written without dense intermediate.
 
     [1] https://github.com/nservant/HiC-Pro
     [2] http://homer.salk.edu/homer/index.html
 
     """
-    binning_information = pd.read_csv(
-        input_bed, names=["replicon", "start", "end", "bin_id"], sep="\t")
-    pair_value_table = pd.read_csv(
-        input_matrix, names=["bin_a", "bin_b", "counting"], sep="\t")
-    
-    bin_id_to_name = dict([
-        (bin_id, "-".join([str(replicon), str(start)]))
-        for bin_id, replicon, start in zip(
-                binning_information.bin_id,
-                binning_information.replicon,
-                binning_information.start)])
-
-    bin_pair_to_value = defaultdict(dict)
-    for bin_a, bin_b, value in zip(
-            pair_value_table["bin_a"], pair_value_table["bin_b"],
-            pair_value_table["counting"]):
-        bin_pair_to_value[bin_a][bin_b] = value
-        bin_pair_to_value[bin_b][bin_a] = value
-
-    result_matrix = pd.DataFrame()
-    result_matrix["HiCMatrix"] = binning_information["bin_id"].apply(
-        lambda bin_id: bin_id_to_name[bin_id])
-    result_matrix["Regions"] = result_matrix["HiCMatrix"]
-
-    # Add column for each bin
-    for bin_a in binning_information["bin_id"]:
-        result_matrix[bin_id_to_name[bin_a]] = binning_information[
-            "bin_id"].apply(
-            lambda bin_b: bin_pair_to_value[bin_a].get(bin_b, 0))
-
-    result_matrix.to_csv(output_matrix, sep="\t", index=False)
+    if is_cooler_file(output_matrix):
+        read_hic_pro(input_bed, input_matrix).save(output_matrix)
+        return
+    if streaming:
+        hicpro2homer_streaming(input_bed, input_matrix, output_matrix,
+                               chunk_size=chunk_size)
+        return
+    with open_file(output_matrix, "w") as output_fh:
+        hic_pro_homer_table(input_bed, input_matrix).to_csv(
+            output_fh, sep="\t", index=False)
+
+
+def read_hic_pro(input_bed: str, input_matrix: str, sparse=True,
+                 packed=False, dtype=None):
+    """Import a HiC-Pro matrix directly as HiCMatrix. By default the
+    values are kept as sparse upper triangle, so only the triplets are
+    held in memory. With sparse=False the values are dense (or packed
+    with packed=True).
+    """
+    binning_information = read_hic_pro_bed(input_bed)
+    with open_file(input_matrix, "rb") as input_matrix_fh:
+        pair_value_table = read_hic_pro_matrix(input_matrix_fh)
+    rows, cols, values = symmetric_cells(
+        binning_information["bin_id"], pair_value_table)
+    upper = rows <= cols
+    number_of_bins = len(binning_information)
+    upper_values = scipy.sparse.csr_matrix(
+        (values[upper], (rows[upper], cols[upper])),
+        shape=(number_of_bins, number_of_bins))
+    bin_index = BinIndex(
+        chroms=binning_information["replicon"].astype(str).to_numpy(
+            dtype=object),
+        starts=binning_information["start"].to_numpy())
+    return HiCMatrix(
+        values=upper_triangle_values(upper_values, sparse=sparse,
+                                     packed=packed),
+        bin_names=hic_pro_bin_names(binning_information),
+        bin_index=bin_index, dtype=dtype)
+
+
+def hic_pro_homer_table(input_bed: str, input_matrix: str):
+    """Return the HiC-Pro matrix as DataFrame in Homer layout (as
+    written by hicpro2homer).
+    """
+    binning_information = read_hic_pro_bed(input_bed)
+    with open_file(input_matrix, "rb") as input_matrix_fh:
+        pair_value_table = read_hic_pro_matrix(input_matrix_fh)
+    bin_names = hic_pro_bin_names(binning_information)
+    rows, cols, values = symmetric_cells(
+        binning_information["bin_id"], pair_value_table)
+
+    matrix_values = np.zeros((len(bin_names), len(bin_names)),
+                             dtype=values.dtype)
+    matrix_values[rows, cols] = values
+    return homer_rows(matrix_values, bin_names, bin_names,
+                      bins_with_interactions(len(bin_names), cols))
+
+
+def hicpro2homer_streaming(input_bed: str, input_matrix: str,
+                           output_matrix: str, chunk_size=1000000,
+                           rows_per_block=100):
+    """Convert the HiC-Pro matrix chunk by chunk of triplets. A row of
+    the Homer matrix is written as soon as all triplets of its bin were
+    read. This requires the triplets to be sorted by their first bin
+    with the first bin not after the second one - as written by HiC-Pro.
+
+    The triplets are read twice: once to find the bins with
+    interactions and the data type and once for the conversion. Only
+    the triplets of rows that are not complete yet (i.e. the mirrored
+    values of the long-range interactions read so far), one chunk of
+    triplets and rows_per_block dense rows are held in memory. The
+    memory for the incomplete rows is not bounded by the chunk size: it
+    grows with the number of long-range interactions of the rows that
+    are not written yet.
+    """
+    binning_information = read_hic_pro_bed(input_bed)
+    bin_names = hic_pro_bin_names(binning_information)
+    bin_ids = binning_information["bin_id"]
+    number_of_bins = len(bin_names)
+
+    # First pass
+    with_interactions = np.zeros(number_of_bins, dtype=bool)
+    value_dtype = None
+    last_first_row = 0
+    for pair_value_table in read_hic_pro_matrix_chunks(
+            input_matrix, chunk_size):
+        rows, cols, values = symmetric_cells(bin_ids, pair_value_table)
+        with_interactions[cols] = True
+        value_dtype = values.dtype if value_dtype is None else (
+            np.result_type(value_dtype, values.dtype))
+        first_rows = _first_rows(bin_ids, pair_value_table)
+        if len(first_rows) == 0:
+            continue
+        if first_rows[0] < last_first_row or np.any(
+                np.diff(first_rows) < 0):
+            sys.stderr.write(
+                "The triplets are not sorted by their first bin. Please "
+                "convert the matrix without streaming.\n")
+            sys.exit(1)
+        last_first_row = first_rows[-1]
+    if value_dtype is None:
+        value_dtype = np.dtype(np.int64)
+
+    # Second pass
+    pending_rows = np.array([], dtype=np.int64)
+    pending_cols = np.array([], dtype=np.int64)
+    pending_values = np.array([], dtype=value_dtype)
+    next_row = 0
+    with open_file(output_matrix, "w") as output_fh:
+        homer_rows(np.zeros((0, number_of_bins), dtype=value_dtype),
+                   bin_names[:0], bin_names, with_interactions).to_csv(
+                       output_fh, sep="\t", index=False)
+        for pair_value_table in read_hic_pro_matrix_chunks(
+                input_matrix, chunk_size):
+            rows, cols, values = symmetric_cells(bin_ids, pair_value_table)
+            pending_rows, pending_cols, pending_values = _merge_cells(
+                pending_rows, pending_cols, pending_values, rows, cols,
+                values)
+            first_rows = _first_rows(bin_ids, pair_value_table)
+            if len(first_rows) == 0:
+                continue
+            # All rows before the first bin of the last triplet are
+            # complete as the following triplets start at this bin
+            complete_rows = max(first_rows[-1], next_row)
+            pending_rows, pending_cols, pending_values = _write_rows(
+                output_fh, next_row, complete_rows, pending_rows,
+                pending_cols, pending_values, bin_names, with_interactions,
+                value_dtype, rows_per_block)
+            next_row = complete_rows
+        _write_rows(output_fh, next_row, number_of_bins, pending_rows,
+                    pending_cols, pending_values, bin_names,
+                    with_interactions, value_dtype, rows_per_block)
+
+
+def _merge_cells(rows, cols, values, new_rows, new_cols, new_values):
+    """Merge the new cells into the cells sorted by row. Only the new
+    cells are sorted. Within a row the cells of earlier triplets stay
+    before the ones of later triplets.
+    """
+    order = np.argsort(new_rows, kind="stable")
+    new_rows = new_rows[order]
+    positions = np.searchsorted(rows, new_rows, side="right")
+    return (np.insert(rows, positions, new_rows),
+            np.insert(cols, positions, new_cols[order]),
+            np.insert(values, positions, new_values[order]))
+
+
+def _first_rows(bin_ids, pair_value_table):
+    """Return the smaller position of the two bins of each triplet with
+    known bins.
+    """
+    bin_positions = pd.Index(bin_ids)
+    positions_a = bin_positions.get_indexer(pair_value_table["bin_a"])
+    positions_b = bin_positions.get_indexer(pair_value_table["bin_b"])
+    known = (positions_a >= 0) & (positions_b >= 0)
+    return np.minimum(positions_a[known], positions_b[known])
+
+
+def _write_rows(output_fh, first_row, end_row, rows, cols, values,
+               bin_names, with_interactions, value_dtype, rows_per_block):
+    """Write the rows first_row to end_row block by block from the cells
+    (sorted by row) and return the cells of the following rows.
+    """
+    for block_start in range(first_row, end_row, rows_per_block):
+        block_end = min(block_start + rows_per_block, end_row)
+        start, end = np.searchsorted(rows, [block_start, block_end])
+        block_rows, block_cols, block_values = last_cells(
+            rows[start:end] - block_start, cols[start:end],
+            values[start:end], len(bin_names))
+        block_matrix_values = np.zeros(
+            (block_end - block_start, len(bin_names)), dtype=value_dtype)
+        block_matrix_values[block_rows, block_cols] = block_values
+        homer_rows(block_matrix_values, bin_names[block_start:block_end],
+                   bin_names, with_interactions).to_csv(
+                       output_fh, sep="\t", index=False, header=False)
+    complete = np.searchsorted(rows, end_row)
+    return rows[complete:], cols[complete:], values[complete:]
+
+
+def homer_rows(matrix_values, row_bin_names, bin_names, with_interactions):
+    """Return the rows as DataFrame in Homer layout.
+    """
+    result_matrix = pd.DataFrame(matrix_values, copy=False)
+    # Bins without any interaction were written as integer zeros before,
+    # also if the other values are floats
+    for position in np.flatnonzero(~with_interactions):
+        if result_matrix.dtypes.iloc[position] != np.int64:
+            result_matrix.isetitem(
+                position, np.zeros(len(row_bin_names), dtype=np.int64))
+    result_matrix.columns = bin_names
+    result_matrix.insert(0, "Regions", row_bin_names)
+    result_matrix.insert(0, "HiCMatrix", row_bin_names)
+    return result_matrix
+
+
+def read_hic_pro_bed(input_bed: str):
+    with open_file(input_bed, "rb") as input_bed_fh:
+        return pd.read_csv(input_bed_fh, sep="\t",
+                           names=["replicon", "start", "end", "bin_id"])
+
+
+def read_hic_pro_matrix(input_matrix, **kwargs):
+    """Read the triplets of a HiC-Pro matrix given as path or open
+    file.
+    """
+    return pd.read_csv(
+        input_matrix, names=["bin_a", "bin_b", "counting"], sep="\t",
+        dtype={"bin_a": np.int64, "bin_b": np.int64}, **kwargs)
+
+
+def read_hic_pro_matrix_chunks(input_matrix: str, chunk_size):
+    """Read the triplets of a (compressed) HiC-Pro matrix in chunks of
+    chunk_size triplets.
+    """
+    with open_file(input_matrix, "rb") as input_matrix_fh:
+        yield from read_hic_pro_matrix(input_matrix_fh, chunksize=chunk_size)
+
+
+def hic_pro_bin_names(binning_information):
+    """Return the bin names (e.g. chr1-10000) as object array.
+    """
+    return (binning_information["replicon"].astype(str) + "-" +
+            binning_information["start"].astype(str)).to_numpy(dtype=object)
+
+
+def symmetric_cells(bin_ids, pair_value_table):
+    """Return rows, columns and values of all cells of the symmetric
+    matrix given by the triplets, i.e. each triplet is used for both
+    directions. The rows and columns are the positions of the bins in
+    bin_ids. Triplets with unknown bins are skipped. If a cell is given
+    several times the last value is used.
+    """
+    bin_positions = pd.Index(bin_ids)
+    positions_a = bin_positions.get_indexer(pair_value_table["bin_a"])
+    positions_b = bin_positions.get_indexer(pair_value_table["bin_b"])
+    known = (positions_a >= 0) & (positions_b >= 0)
+    # Both directions of each triplet in the order of the triplets
+    rows = np.column_stack((positions_a[known], positions_b[known])).ravel()
+    cols = np.column_stack((positions_b[known], positions_a[known])).ravel()
+    values = np.repeat(pair_value_table["counting"].to_numpy()[known], 2)
+    return last_cells(rows, cols, values, len(bin_ids))
+
+
+def last_cells(rows, cols, values, number_of_cols):
+    """Keep only the last value of cells that are given several times.
+    """
+    cells = rows * number_of_cols + cols
+    _, last_reversed = np.unique(cells[::-1], return_index=True)
+    last = len(cells) - 1 - last_reversed
+    return rows[last], cols[last], values[last]
+
+
+def bins_with_interactions(number_of_bins, cols):
+    with_interactions = np.zeros(number_of_bins, dtype=bool)
+    with_interactions[cols] = True
+    return with_interactions
@@ -1,9 +1,13 @@
-from collections import defaultdict
+import numpy as np
 import pandas as pd
+import scipy.sparse
 from natsort import natsorted
+from hicsuntdracones.compressedio import open_file
+from hicsuntdracones.hicmatrix import write_homer_header, write_homer_rows
+from hicsuntdracones.hicpro2homer import last_cells
 
 
-def mHiC2homer(input_matrix: str, output_matrix: str):
+def mHiC2homer(input_matrix: str, output_matrix: str, chunk_size=1000):
     """Converts HiC interaction matrices generated by the mHiC pipeline [1]
     (and all tools that have the same output format) into the format used by Homer [2].
 
@@ -11,33 +15,42 @@ def mHiC2homer(input_matrix: str, output_matrix: str):
     Ludwig-Maximilians-Universitaet Munich
     2019
 
+    The bins are sorted once and mapped to integer positions. The
+    interactions are scattered into a sparse matrix which is written
+    block by block of chunk_size rows.
+
     [1] https://github.com/yezhengSTAT/mHiC
     [2] http://homer.salk.edu/homer/index.html
     """
 
-    binning_information = pd.read_csv(
-        input_matrix, names=["interaction", "count"], sep="\t")
+    with open_file(input_matrix, "rb") as input_matrix_fh:
+        binning_information = pd.read_csv(
+            input_matrix_fh, names=["interaction", "count"], sep="\t")
 
     tmp = binning_information["interaction"].str.split(' ', expand=True)
-
-    interaction_matrix = pd.DataFrame()
-    interaction_matrix["bin_a"] = tmp[0] + "-" + tmp[1]
-    interaction_matrix["bin_b"] = tmp[2] + "-" + tmp[3]
-    interaction_matrix["frequency"] = binning_information["count"]
-
-    bin_pair_to_value = defaultdict(dict)
-    for bin_a, bin_b, value in zip(
-            interaction_matrix["bin_a"], interaction_matrix["bin_b"],
-            interaction_matrix["frequency"]):
-        bin_pair_to_value[bin_a][bin_b] = value
-        bin_pair_to_value[bin_b][bin_a] = value
-
-    result_matrix = pd.DataFrame()
-    result_matrix["HiCMatrix"] = natsorted(bin_pair_to_value.keys())
-    result_matrix["Regions"] = result_matrix["HiCMatrix"]
-
-    # Add column for each bin
-    for bin_a in natsorted(bin_pair_to_value.keys()):
-        result_matrix[bin_a] = [bin_pair_to_value[bin_a].get(key,0) for key in natsorted(bin_pair_to_value.keys())]
-
-    result_matrix.to_csv(output_matrix, sep="\t", index=False)
+    bins_a = (tmp[0] + "-" + tmp[1]).to_numpy(dtype=object)
+    bins_b = (tmp[2] + "-" + tmp[3]).to_numpy(dtype=object)
+
+    bin_names = np.array(
+        natsorted(pd.unique(np.concatenate((bins_a, bins_b)))), dtype=object)
+    bin_positions = pd.Index(bin_names)
+    positions_a = bin_positions.get_indexer(bins_a)
+    positions_b = bin_positions.get_indexer(bins_b)
+
+    # Both directions of each interaction in the order of the file - if
+    # a pair is given several times the last value is used
+    rows, cols, values = last_cells(
+        np.column_stack((positions_a, positions_b)).ravel(),
+        np.column_stack((positions_b, positions_a)).ravel(),
+        np.repeat(binning_information["count"].to_numpy(), 2),
+        len(bin_names))
+    interaction_matrix = scipy.sparse.csr_matrix(
+        (values, (rows, cols)), shape=(len(bin_names), len(bin_names)))
+
+    with open_file(output_matrix, "w") as output_fh:
+        write_homer_header(output_fh, bin_names)
+        for start in range(0, len(bin_names), chunk_size):
+            end = min(start + chunk_size, len(bin_names))
+            write_homer_rows(output_fh,
+                             interaction_matrix[start:end].toarray(),
+                             bin_names[start:end])
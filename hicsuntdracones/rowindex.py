@@ -0,0 +1,130 @@
+import io
+import itertools
+import os
+import sys
+import numpy as np
+import pandas as pd
+
+ROW_INDEX_SUFFIX = ".hicsd.rows.npz"
+
+
+class RowIndex:
+    """Byte offsets of the rows of a matrix file in Homer format. With
+    them single rows can be read without parsing the rows before.
+
+    Besides the offsets (one per row plus the end of the file) the sum
+    and the minimum of each row are stored. As Hi-C matrices are
+    symmetric the row sums are also the column sums, so the column sum
+    median and the global minimum are known without reading the values.
+    """
+
+    def __init__(self, offsets, row_sums, row_mins):
+        self.offsets = np.asarray(offsets, dtype=np.int64)
+        self.row_sums = np.asarray(row_sums)
+        self.row_mins = np.asarray(row_mins)
+
+    def __len__(self):
+        return len(self.offsets) - 1
+
+    def column_sum_median(self):
+        return np.median(self.row_sums)
+
+    def min_value(self):
+        return np.nanmin(self.row_mins)
+
+    def read_rows(self, matrix_file, rows, columns=None, dtype=None):
+        """Read the values of the given (ascending) rows. Only the given
+        columns are converted, all columns if columns is None.
+        Contiguous rows are read with one read call.
+        """
+        rows = np.asarray(rows, dtype=np.int64)
+        if columns is None:
+            columns = np.arange(len(self))
+        chunks = []
+        with open(matrix_file, "rb") as matrix_fh:
+            for row_run in np.split(
+                    rows, np.flatnonzero(np.diff(rows) != 1) + 1):
+                if len(row_run) == 0:
+                    continue
+                matrix_fh.seek(self.offsets[row_run[0]])
+                chunks.append(matrix_fh.read(
+                    self.offsets[row_run[-1] + 1] - self.offsets[row_run[0]]))
+        if len(rows) == 0 or len(columns) == 0:
+            return np.empty((len(rows), len(columns)), dtype=dtype)
+        # The first two columns contain the bin names
+        return pd.read_csv(
+            io.BytesIO(b"".join(chunks)), sep="\t", header=None,
+            usecols=(np.asarray(columns) + 2).tolist(),
+            dtype=dtype).to_numpy()
+
+
+def row_index_file(matrix_file: str):
+    return matrix_file + ROW_INDEX_SUFFIX
+
+
+def row_index_is_current(matrix_file: str):
+    """The index is only used if it is not older than the matrix file.
+    """
+    index_file = row_index_file(matrix_file)
+    return os.path.exists(index_file) and (
+        os.path.getmtime(index_file) >= os.path.getmtime(matrix_file))
+
+
+def build_row_index(matrix_file: str, chunk_size=1000):
+    """Go once through the matrix file block by block of rows and record
+    the byte offset, the sum and the minimum of each row.
+    """
+    offsets = []
+    row_sums = []
+    row_mins = []
+    with open(matrix_file, "rb") as matrix_fh:
+        offset = len(matrix_fh.readline())
+        while True:
+            lines = list(itertools.islice(matrix_fh, chunk_size))
+            if not lines:
+                break
+            for line in lines:
+                offsets.append(offset)
+                offset += len(line)
+            # The rows are made contiguous so that they are summed up in
+            # the same order as the columns of the whole matrix
+            block = np.ascontiguousarray(pd.read_csv(
+                io.BytesIO(b"".join(lines)), sep="\t",
+                header=None).iloc[0:, 2:].to_numpy())
+            row_sums.append(np.nansum(block, axis=1))
+            row_mins.append(np.nanmin(block, axis=1))
+    offsets.append(offset)
+    return RowIndex(offsets, np.concatenate(row_sums),
+                    np.concatenate(row_mins))
+
+
+def write_row_index(row_index, matrix_file: str):
+    """Write the index next to the matrix file. It is written to a
+    temporary file first and then moved in place.
+    """
+    index_tmp_file = row_index_file(matrix_file) + ".tmp"
+    with open(index_tmp_file, "wb") as index_fh:
+        np.savez(index_fh, offsets=row_index.offsets,
+                 row_sums=row_index.row_sums, row_mins=row_index.row_mins)
+    os.replace(index_tmp_file, row_index_file(matrix_file))
+
+
+def read_row_index(matrix_file: str):
+    with np.load(row_index_file(matrix_file)) as index_data:
+        return RowIndex(index_data["offsets"], index_data["row_sums"],
+                        index_data["row_mins"])
+
+
+def get_row_index(matrix_file: str):
+    """Read the row index of the matrix file. If it does not exist or
+    is outdated it is built and stored for the following runs.
+    """
+    if row_index_is_current(matrix_file):
+        return read_row_index(matrix_file)
+    row_index = build_row_index(matrix_file)
+    try:
+        write_row_index(row_index, matrix_file)
+    except OSError as error:
+        sys.stderr.write(f"Could not write row index of {matrix_file}: "
+                         f"{error}\n")
+    return row_index
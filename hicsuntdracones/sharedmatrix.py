@@ -0,0 +1,103 @@
+from contextlib import contextmanager
+import multiprocessing
+import os
+import tempfile
+import numpy as np
+from scipy import sparse
+from hicsuntdracones.hicmatrix import HiCMatrix
+
+# Matrices that forked worker processes inherit from the parent process
+_INHERITED_MATRICES = {}
+
+
+class InheritedHiCMatrix:
+    """Handle of a matrix that forked worker processes inherit from the
+    parent process. Only the key of the matrix is pickled, the values
+    are shared copy-on-write by the operating system.
+    """
+
+    def __init__(self, key):
+        self._key = key
+
+    def load(self):
+        """Return the inherited matrix.
+        """
+        return _INHERITED_MATRICES[self._key]
+
+
+class SharedHiCMatrix:
+    """The values of a matrix stored as .npy files that are memory mapped
+    by each process loading the matrix. The processes share the pages of
+    the files, so the values are held in memory only once. Only the
+    (small) description is pickled when it is sent to a worker process.
+    """
+
+    def __init__(self, array_files, bin_names, bin_index, fill_value, dtype,
+                 shape=None):
+        self._array_files = array_files
+        self._bin_names = bin_names
+        self._bin_index = bin_index
+        self._fill_value = fill_value
+        self._dtype = dtype
+        # Only set for sparse matrices
+        self._shape = shape
+
+    def load(self):
+        """Return the matrix with memory mapped (read only) values.
+        """
+        if self._shape is not None:
+            values = sparse.csr_matrix(
+                tuple(np.load(self._array_files[name], mmap_mode="r")
+                      for name in ("data", "indices", "indptr")),
+                shape=self._shape, copy=False)
+        else:
+            values = np.load(self._array_files["values"], mmap_mode="r")
+        return HiCMatrix(values=values, bin_names=self._bin_names,
+                         fill_value=self._fill_value,
+                         bin_index=self._bin_index, dtype=self._dtype)
+
+
+@contextmanager
+def shared_hic_matrix(hic_matrix, values_file=None, inherit=None):
+    """Share the (dense, sparse or packed) matrix with worker processes
+    that are started within the context.
+
+    Forked workers (the default on POSIX systems, see inherit) inherit
+    the matrix from this process. Otherwise the workers memory map the
+    values: from values_file (a .npy file with the unchanged values of
+    a dense matrix, e.g. its binary cache) if given, else from .npy files
+    written to a temporary directory that is removed when the context is
+    left.
+    """
+    if inherit is None:
+        inherit = multiprocessing.get_start_method() == "fork"
+    if inherit:
+        key = id(hic_matrix)
+        _INHERITED_MATRICES[key] = hic_matrix
+        try:
+            yield InheritedHiCMatrix(key)
+        finally:
+            del _INHERITED_MATRICES[key]
+        return
+    if values_file is not None:
+        yield SharedHiCMatrix(
+            {"values": values_file}, hic_matrix._bin_names,
+            hic_matrix.bin_index, hic_matrix._fill_value, hic_matrix._dtype)
+        return
+    with tempfile.TemporaryDirectory(prefix="hicsd_") as directory:
+        values = hic_matrix._values
+        shape = None
+        if hic_matrix.is_sparse():
+            values = values.tocsr()
+            shape = values.shape
+            arrays = {"data": values.data, "indices": values.indices,
+                      "indptr": values.indptr}
+        else:
+            arrays = {"values": values}
+        array_files = dict((name, os.path.join(directory, f"{name}.npy"))
+                           for name in arrays)
+        for name, array in arrays.items():
+            np.save(array_files[name], array)
+        yield SharedHiCMatrix(
+            array_files, hic_matrix._bin_names, hic_matrix.bin_index,
+            hic_matrix._fill_value, hic_matrix._dtype, shape=shape)
@@ -6,8 +6,10 @@ import hicsuntdracones.hicmatrix
 class Virtual4C(object):
 
     def __init__(self, matrix_file, gff_file, bin_size, track_name,
-                 output_file):
+                 output_file, dtype=None, row_index=False):
         self._matrix_file = matrix_file
+        self._dtype = dtype
+        self._row_index = row_index
         self._gff_file = gff_file
         self._bin_size = bin_size
         self._track_name = track_name
@@ -22,18 +24,21 @@ class Virtual4C(object):
         annotation.
         """
         print("- Reading HiC matrix file")
-        self.hic_matrix = hicsuntdracones.hicmatrix.HiCMatrix(
-            self._matrix_file)
-        self.hic_matrix.hic_matrix_df.set_index(
-            self.hic_matrix.hic_matrix_df["Regions"], inplace=True)
-        self.hic_matrix.normalize_by_columns_sum()
-        for genome_bin in self.hic_matrix.bins():
-            chrom = hicsuntdracones.hicmatrix.remove_position_information(
-                genome_bin)
-            # As the bin counting starts with 0 but the gff starts a 1
-            # we have to add 1 here to the position.
-            pos = hicsuntdracones.hicmatrix.bin_number(genome_bin)
-            pos_adjusted = pos + 1
+        if self._row_index:
+            # Only the header is read here. The rows of the bins that
+            # overlap the features are read when writing the wiggle file.
+            self.hic_matrix = hicsuntdracones.hicmatrix.read_hic_matrix(
+                self._matrix_file, dtype=self._dtype, row_index=True)
+        else:
+            self.hic_matrix = hicsuntdracones.hicmatrix.HiCMatrix(
+                self._matrix_file, dtype=self._dtype)
+            self.hic_matrix.normalize_by_columns_sum()
+        # As the bin counting starts with 0 but the gff starts a 1
+        # we have to add 1 here to the position.
+        bin_index = self.hic_matrix.bin_index
+        for genome_bin, chrom, pos_adjusted in zip(
+                self.hic_matrix.bins(), bin_index.chroms(),
+                (bin_index.starts + 1).tolist()):
             self._features.update([gffutils.Feature(
                 seqid=chrom,
                 source='-',
@@ -67,6 +72,20 @@ class Virtual4C(object):
 
         """
         print("- Writing wiggle file")
+        bin_positions = dict(
+            (bin_name, position)
+            for position, bin_name in enumerate(self.hic_matrix.bins()))
+        # The interactions of each bin (row) with the bins overlapping the
+        # features (columns). As the matrix is symmetric these are the
+        # rows of the overlapping bins.
+        overlapping_bin_rows = self.hic_matrix.rows(
+            [bin_positions[bin_name]
+             for bin_name in self._feature_overlapping_bins])
+        if self._row_index:
+            overlapping_bin_rows = (
+                overlapping_bin_rows / self.hic_matrix.column_sum_median())
+        interaction_values_of_bins = np.ascontiguousarray(
+            overlapping_bin_rows.T)
         output_fh = open(self._output_file, "w")
         output_fh.write(f'track type=wiggle_0 name="{self._track_name}"\n')
         current_chrom = ""
@@ -80,8 +99,8 @@ class Virtual4C(object):
                 current_chrom = hic_bin_feature.seqid
                 output_fh.write(f'variableStep chrom={current_chrom} span={self._bin_size}\n')
             hic_bin_name = hic_bin_feature.attributes["ID"][0]
-            interaction_values = self.hic_matrix.matrix_values()[
-                self._feature_overlapping_bins].loc[hic_bin_name].tolist()
+            interaction_values = interaction_values_of_bins[
+                bin_positions[hic_bin_name]]
             output_fh.write(f"{hic_bin_feature.start} {np.mean(interaction_values)}\n")
         output_fh.close()
 
@@ -0,0 +1,10 @@
+import pytest
+
+
+@pytest.fixture(params=[{}, {"sparse": True}, {"packed": True}],
+                ids=["dense", "sparse", "packed"])
+def layout_kwargs(request):
+    """Keyword arguments of HiCMatrix for the dense, sparse and packed
+    layout of the values.
+    """
+    return request.param
@@ -0,0 +1,36 @@
+import numpy as np
+import pytest
+import hicsuntdracones.binindex
+
+
+def test_bin_index():
+    bin_index = hicsuntdracones.binindex.BinIndex(
+        bin_names=["chr1-0", "chr1-10000", "chr1-20000",
+                   "chr-2-0", "chr-2-10000"])
+    assert bin_index.chrom_names == ["chr1", "chr-2"]
+    np.testing.assert_array_equal(bin_index.chrom_codes, [0, 0, 0, 1, 1])
+    np.testing.assert_array_equal(
+        bin_index.starts, [0, 10000, 20000, 0, 10000])
+    np.testing.assert_array_equal(bin_index.offsets, [0, 3, 5])
+    assert bin_index.chrom_positions("chr-2") == slice(3, 5)
+    assert bin_index.chrom_lengths() == {"chr1": 20000, "chr-2": 10000}
+
+
+def test_bin_index_not_contiguous():
+    bin_index = hicsuntdracones.binindex.BinIndex(
+        bin_names=["chr1-0", "chr2-0", "chr1-10000"])
+    assert not bin_index.is_contiguous
+    np.testing.assert_array_equal(bin_index.chrom_positions("chr1"), [0, 2])
+
+
+def test_bin_index_take():
+    bin_index = hicsuntdracones.binindex.BinIndex(
+        bin_names=["chr1-0", "chr1-10000", "chr2-0", "chr2-10000"])
+    sub_bin_index = bin_index.take(np.array([1, 3]))
+    assert sub_bin_index.chrom_names == ["chr1", "chr2"]
+    np.testing.assert_array_equal(sub_bin_index.starts, [10000, 10000])
+
+
+def test_bin_names_without_start():
+    with pytest.raises(SystemExit):
+        hicsuntdracones.binindex.BinIndex(bin_names=["chr1-0", "bin7"])
@@ -1,5 +1,7 @@
 
+import numpy as np
 import hicsuntdracones.colocalization as c
+import hicsuntdracones.hicmatrix
 import hashlib
 import os
 import random
@@ -69,3 +71,19 @@ def test_read_gff_file():
     if os.path.exists("./myout__histograms.pdf"):
         os.remove("./myout__histograms.pdf")
     '''
+
+
+def test_extract_selected_countings():
+    bin_names = ["chr1-0", "chr10-0", "chr2-random-0", "chr2-random-100"]
+    hic_matrix = hicsuntdracones.hicmatrix.HiCMatrix(
+        values=np.arange(16.0).reshape(4, 4), bin_names=bin_names)
+    interaction_matrix = hic_matrix.hic_matrix_df.set_index("Regions")
+    colo = c.ColocalizationTester("tests/fixtures/50000_testmatrix.txt",
+                                  "tests/fixtures/Testgenome.gff",
+                                  "CDS", 100, "myout_", 2, 10, True, True)
+    colo._bin_index = hic_matrix.bin_index
+    countings = colo._extract_selected_countings(
+        ["chr1-0", "chr10-0", "chr2-random-0", "chr2-random-100"],
+        interaction_matrix)
+    assert countings.tolist() == [1.0, 2.0, 3.0, 4.0, 6.0, 7.0,
+                                  8.0, 9.0, 12.0, 13.0]
@@ -0,0 +1,48 @@
+import numpy as np
+import shutil
+import pytest
+import hicsuntdracones.compressedio
+import hicsuntdracones.hicmatrix
+
+
+@pytest.mark.parametrize("suffix", [".gz", ".zst"])
+def test_open_file(suffix, tmp_path):
+    if suffix == ".zst" and shutil.which("zstd") is None:
+        pytest.skip("zstd is not installed")
+    tmp_output = str(tmp_path / ("compressed" + suffix))
+    with hicsuntdracones.compressedio.open_file(tmp_output, "w") as output_fh:
+        output_fh.write("a\tb\n1\t2\n")
+    with hicsuntdracones.compressedio.open_file(tmp_output) as input_fh:
+        assert input_fh.readline() == "a\tb\n"
+    with hicsuntdracones.compressedio.open_file(tmp_output) as input_fh:
+        assert input_fh.read() == "a\tb\n1\t2\n"
+
+
+def test_open_file_keeps_exception(tmp_path):
+    tmp_output = str(tmp_path / "corrupt.gz")
+    with open(tmp_output, "w") as output_fh:
+        output_fh.write("not compressed\n")
+    # The exception raised while reading is not replaced by the failure
+    # of the decompressor
+    with pytest.raises(KeyError):
+        with hicsuntdracones.compressedio.open_file(tmp_output) as input_fh:
+            input_fh.read()
+            raise KeyError("error while reading")
+    with pytest.raises(SystemExit):
+        with hicsuntdracones.compressedio.open_file(tmp_output) as input_fh:
+            input_fh.read()
+
+
+@pytest.mark.parametrize(
+    "kwargs", [{}, {"sparse": True}, {"packed": True}, {"lazy": True}],
+    ids=["dense", "sparse", "packed", "lazy"])
+def test_compressed_hic_matrix(kwargs, tmp_path):
+    tmp_output = str(tmp_path / "homer_matrix_small.txt.gz")
+    hic_matrix = hicsuntdracones.hicmatrix.HiCMatrix(
+        "tests/fixtures/homer_matrix_small.txt")
+    hic_matrix.save(tmp_output)
+    compressed_hic_matrix = hicsuntdracones.hicmatrix.HiCMatrix(
+        tmp_output, **kwargs)
+    assert list(compressed_hic_matrix.bins()) == list(hic_matrix.bins())
+    assert np.array_equal(compressed_hic_matrix._dense_values(),
+                          hic_matrix._dense_values())
@@ -0,0 +1,48 @@
+import numpy as np
+import pytest
+import hicsuntdracones.hicmatrix
+
+pytest.importorskip("h5py")
+
+
+def test_save_and_read_cooler(layout_kwargs, tmp_path):
+    tmp_output = str(tmp_path / "homer_matrix_small.cool")
+    hic_matrix = hicsuntdracones.hicmatrix.HiCMatrix(
+        "tests/fixtures/homer_matrix_small.txt")
+    hic_matrix.save(tmp_output)
+    cooler_matrix = hicsuntdracones.hicmatrix.read_hic_matrix(
+        tmp_output, **layout_kwargs)
+    assert list(cooler_matrix.bins()) == list(hic_matrix.bins())
+    assert np.array_equal(cooler_matrix._dense_values(),
+                          hic_matrix._dense_values())
+
+
+def test_cooler_select_region(tmp_path):
+    tmp_output = str(tmp_path / "50000_testmatrix.mcool")
+    hic_matrix = hicsuntdracones.hicmatrix.HiCMatrix(
+        "tests/fixtures/50000_testmatrix.txt")
+    hic_matrix.save(tmp_output)
+    cooler_matrix = hicsuntdracones.hicmatrix.read_hic_matrix(
+        tmp_output + "::resolutions/50000")
+    regions = ("Chr1_core_Tb427v9:0-200000", "Chr3_core_Tb427v9")
+    # Only the pixels of the regions are read from the file
+    submatrix = cooler_matrix.select_region(*regions)
+    assert cooler_matrix._lazy
+    assert np.array_equal(
+        submatrix._dense_values(),
+        hic_matrix.select_region(*regions)._dense_values())
+    assert cooler_matrix._min_value() == hic_matrix._min_value()
+
+
+def test_coarsen_hic_matrix_file(tmp_path):
+    tmp_output = str(tmp_path / "50000_testmatrix_pyramid.mcool")
+    hicsuntdracones.hicmatrix.coarsen_hic_matrix_file(
+        "tests/fixtures/50000_testmatrix.txt", tmp_output, [1, 2, 5],
+        chunk_size=7)
+    hic_matrix = hicsuntdracones.hicmatrix.HiCMatrix(
+        "tests/fixtures/50000_testmatrix.txt")
+    for factor in (1, 2, 5):
+        level = hicsuntdracones.hicmatrix.read_hic_matrix(
+            f"{tmp_output}::resolutions/{50000 * factor}")
+        assert np.allclose(level._dense_values(),
+                           hic_matrix.coarsen(factor)._dense_values())
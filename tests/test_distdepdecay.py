@@ -1,7 +1,11 @@
 import hicsuntdracones.distdepdecay as d
+import hicsuntdracones.hicmatrix
 import hashlib
 import shutil
 import os
+import subprocess
+import sys
+import numpy as np
 '''
 
 def test_distdepdecay():
@@ -30,7 +34,8 @@ def test_distdepdecay():
 def test_write_table():
     dddo_generator = d.DistDepDecayOutputGenerator("tests/fixtures/50000_testmatrix.txt",
                                                    65,
-                                                   "myout_")
+                                                   "myout_",
+                                                   keep_countings=True)
     dddo_generator.write_table_file()
     write_table_file_content_target = open("tests/fixtures/ddd_example.csv").read()
     write_table_file_content_generated = open("./myout__distance_dependent_decay.csv").read()
@@ -78,7 +83,8 @@ def test_plot_bin_averages_with_error_bars():
 def test_plot_all_values():
     dddo_generator = d.DistDepDecayOutputGenerator("tests/fixtures/50000_testmatrix.txt",
                                                    65,
-                                                   "myout_")
+                                                   "myout_",
+                                                   keep_countings=True)
     dddo_generator.plot_all_values()
     plot_all_values_target = open("tests/fixtures/ddd_example.csv").read()
     plot_all_values_generated = open("./myout__distance_dependent_decay.csv").read()
@@ -93,6 +99,101 @@ def test_plot_all_values():
     if os.path.exists("./myout__distance_dependent_decay.csv"):
         os.remove("./myout__distance_dependent_decay.csv")
 
+def test_distance_statistics():
+    statistics = d.DistanceStatistics()
+    statistics.add("chr1", 0.0, [1.0, 4.0])
+    statistics.add("chr1", 0.0, [2.0, 8.0, 5.0])
+    statistics.add("chr1", 10.0, [3.0])
+    assert statistics.chroms() == ["chr1"]
+    assert statistics.dists("chr1") == [0.0, 10.0]
+    assert statistics.number("chr1", 0.0) == 5
+    assert np.isclose(statistics.mean("chr1", 0.0), 4.0)
+    assert np.isclose(statistics.std("chr1", 0.0),
+                      np.std([1.0, 4.0, 2.0, 8.0, 5.0]))
+    assert statistics.std("chr1", 10.0) == 0.0
+
+
+def test_write_table_without_countings(tmp_path):
+    dddo_generator = d.DistDepDecayOutputGenerator(
+        "tests/fixtures/homer_matrix.csv", 10000, str(tmp_path / "out"),
+        keep_countings=False)
+    dddo_generator.write_table_file()
+    lines = open(tmp_path / "out_distance_dependent_decay.csv").readlines()
+    assert lines[1] == "chr1\t0.0\t73.8\t17.451647486698786\t\t5\n"
+
+
+def test_parallel_decay(tmp_path):
+    for processes in (1, 2):
+        dddo_generator = d.DistDepDecayOutputGenerator(
+            "tests/fixtures/homer_matrix.csv", 10000,
+            str(tmp_path / f"out_{processes}"), keep_countings=True,
+            processes=processes)
+        dddo_generator.write_table_file()
+    assert open(tmp_path / "out_1_distance_dependent_decay.csv").read() == (
+        open(tmp_path / "out_2_distance_dependent_decay.csv").read())
+    # From the binary cache of the matrix
+    matrix_file = str(tmp_path / "matrix.txt")
+    shutil.copy("tests/fixtures/homer_matrix.csv", matrix_file)
+    hicsuntdracones.hicmatrix.read_hic_matrix(matrix_file, use_cache=True)
+    dddo_generator = d.DistDepDecayOutputGenerator(
+        matrix_file, 10000, str(tmp_path / "out_cache"), keep_countings=True,
+        processes=2)
+    dddo_generator.write_table_file()
+    assert open(tmp_path / "out_1_distance_dependent_decay.csv").read() == (
+        open(tmp_path / "out_cache_distance_dependent_decay.csv").read())
+
+
+def test_log_binned_contact_probability():
+    dists = np.array([0.0, 10.0, 20.0, 40.0, 80.0])
+    numbers = np.array([5, 4, 3, 2, 1])
+    means = np.array([100.0, 100.0, 50.0, 25.0, 12.5])
+    table = d.log_binned_contact_probability(dists, numbers, means, 10,
+                                             bins_per_decade=10)
+    assert table["Distance start"].tolist() == [10.0, 20.0, 40.0, 80.0]
+    assert table["Number of pairs"].tolist() == [4, 3, 2, 1]
+    np.testing.assert_allclose(table["Distance"], [10.0, 20.0, 40.0, 80.0])
+    np.testing.assert_allclose(table["Contact probability"],
+                               means[1:] / np.sum(numbers * means))
+    np.testing.assert_allclose(table["Slope"], -1.0)
+    table = d.log_binned_contact_probability(dists, numbers, means, 10,
+                                             bins_per_decade=1)
+    assert table["Distance start"].tolist() == [10.0]
+    assert table["Distance end"].tolist() == [100.0]
+    assert table["Number of pairs"].tolist() == [10]
+
+
+def test_write_npz_file(tmp_path):
+    for keep_countings in (True, False):
+        dddo_generator = d.DistDepDecayOutputGenerator(
+            "tests/fixtures/homer_matrix.csv", 10000, str(tmp_path / "out"),
+            keep_countings=keep_countings)
+        dddo_generator.write_npz_file()
+        with np.load(tmp_path / "out_distance_dependent_decay.npz") as table:
+            assert table["chrom"].tolist()[:6] == ["chr1"] * 5 + ["chr2"]
+            assert table["dist"].tolist()[:6] == [
+                0.0, 10000.0, 20000.0, 30000.0, 40000.0, 0.0]
+            assert table["n"].tolist()[:6] == [5, 4, 3, 2, 1, 7]
+            assert table["mean"][0] == 73.8
+            assert ("countings" in table) == keep_countings
+            if keep_countings:
+                offsets = table["countings_offsets"]
+                assert table["countings"][offsets[4]:offsets[5]].tolist() == (
+                    [11.0])
+                assert offsets[-1] == len(table["countings"]) == 15 + 28
+
+
+def test_cli_log_bins_and_npz(tmp_path):
+    prefix = str(tmp_path / "out")
+    subprocess.run(
+        [sys.executable, "bin/hicsd", "dist_dep_decay",
+         "-m", "tests/fixtures/homer_matrix.csv", "-b", "10000",
+         "-o", prefix, "-l", "10", "--npz"],
+        check=True, env=dict(os.environ, PYTHONPATH=os.getcwd()))
+    assert os.path.exists(prefix + "_contact_probability.csv")
+    assert os.path.exists(prefix + "_distance_dependent_decay.npz")
+    assert not os.path.exists(prefix + "_distance_dependent_decay.csv")
+
+
 #def _get_hash(path):
  #   hash = hashlib.md5(open(path, 'rb').read()).hexdigest()
   #  return hash
@@ -2,9 +2,14 @@ import pandas as pd
 import numpy as np
 import hicsuntdracones.hicmatrix
 import pytest
+import os
+import shutil
+import subprocess
+import sys
 
 @pytest.mark.skip(reason="not a proper test needs to be fixed")
 
+
 def test_matrix_generation():
     hic_matrix = hicsuntdracones.hicmatrix.HiCMatrix(
         "tests/fixtures/homer_matrix.csv")
@@ -191,6 +196,7 @@ def test_div_matrix_inplace():
         hic_matrix_1.hic_matrix_df)
 '''
 
+
 def test__get_counts_for_chroms():
     hic_matrix = hicsuntdracones.hicmatrix.HiCMatrix(
         "tests/fixtures/homer_matrix.csv")
@@ -239,3 +245,412 @@ def test__get_counts_for_chroms():
     np.testing.assert_array_equal(
         chroms_dists_and_countings["chr2"]["dists"],
         expected_chroms_dists_and_countings["chr2"]["dists"])
+
+
+def test_read_hic_matrix_binary_cache(tmp_path):
+    matrix_file = str(tmp_path / "homer_matrix_small.txt")
+    shutil.copy("tests/fixtures/homer_matrix_small.txt", matrix_file)
+    hicsuntdracones.hicmatrix.read_hic_matrix(matrix_file)
+    assert not os.path.exists(matrix_file + ".hicsd.npy")
+    hic_matrix = hicsuntdracones.hicmatrix.read_hic_matrix(
+        matrix_file, use_cache=True)
+    assert os.path.exists(matrix_file + ".hicsd.npy")
+    assert os.path.exists(matrix_file + ".hicsd.bins")
+    assert os.path.exists(matrix_file + ".hicsd.npy.source")
+    cached_hic_matrix = hicsuntdracones.hicmatrix.read_hic_matrix(
+        matrix_file, use_cache=True)
+    assert isinstance(cached_hic_matrix._values, np.memmap)
+    assert cached_hic_matrix.number_of_bins == 4
+    assert cached_hic_matrix.chromosomes == ["chr1", "chr2"]
+    pd.testing.assert_frame_equal(
+        hic_matrix.hic_matrix_df, cached_hic_matrix.hic_matrix_df)
+    # A changed size invalidates the cache even if the modification time
+    # is kept (e.g. by cp -p)
+    stat = os.stat(matrix_file)
+    with open(matrix_file) as matrix_fh:
+        content = matrix_fh.read().replace("13.0", "13.25")
+    with open(matrix_file, "w") as matrix_fh:
+        matrix_fh.write(content)
+    os.utime(matrix_file, ns=(stat.st_atime_ns, stat.st_mtime_ns))
+    assert not hicsuntdracones.hicmatrix.binary_cache_is_current(
+        matrix_file)
+    changed_hic_matrix = hicsuntdracones.hicmatrix.read_hic_matrix(
+        matrix_file, use_cache=True)
+    assert changed_hic_matrix._dense_values()[1, 1] == 13.25
+
+
+def test_read_hic_matrix_binary_cache_not_writable(tmp_path, monkeypatch):
+    matrix_file = str(tmp_path / "homer_matrix_small.txt")
+    shutil.copy("tests/fixtures/homer_matrix_small.txt", matrix_file)
+    monkeypatch.setattr(os, "access", lambda path, mode: False)
+    hic_matrix = hicsuntdracones.hicmatrix.read_hic_matrix(
+        matrix_file, use_cache=True)
+    assert hic_matrix.number_of_bins == 4
+    assert os.listdir(tmp_path) == ["homer_matrix_small.txt"]
+
+
+def test_sparse_matrix_values():
+    hic_matrix = hicsuntdracones.hicmatrix.HiCMatrix(
+        "tests/fixtures/homer_matrix_small.txt", sparse=True)
+    assert hic_matrix.is_sparse()
+    assert hic_matrix._values.nnz == 6
+    np.testing.assert_array_equal(
+        hic_matrix.matrix_values().sparse.to_dense().to_numpy(),
+        np.array([[10.0, 3.0, 0.0, 7.0],
+                  [3.0, 13.0, 0.0, 4.0],
+                  [0.0, 0.0, 0.0, 0.0],
+                  [7.0, 4.0, 0.0, 9.0]]))
+
+
+def test_sparse_normalize_by_columns_sum():
+    hic_matrix = hicsuntdracones.hicmatrix.HiCMatrix(
+        "tests/fixtures/homer_matrix_small.txt")
+    sparse_hic_matrix = hicsuntdracones.hicmatrix.HiCMatrix(
+        "tests/fixtures/homer_matrix_small.txt", sparse=True)
+    assert sparse_hic_matrix._calc_column_sum_median() == 20.0
+    hic_matrix.normalize_by_columns_sum()
+    sparse_hic_matrix.normalize_by_columns_sum()
+    assert sparse_hic_matrix.is_sparse()
+    pd.testing.assert_frame_equal(
+        hic_matrix.hic_matrix_df, sparse_hic_matrix.hic_matrix_df)
+
+
+def test_sparse_select_keep_pattern():
+    hic_matrix = hicsuntdracones.hicmatrix.HiCMatrix(
+        "tests/fixtures/homer_matrix_small.txt", sparse=True)
+    sub_hic_matrix = hic_matrix.select(keep_pattern="chr1")
+    assert sub_hic_matrix.is_sparse()
+    pd.testing.assert_frame_equal(
+        pd.DataFrame.from_dict(
+            {"HiCMatrix": [
+                "chr1-0", "chr1-10000"],
+             "Regions": [
+                 "chr1-0", "chr1-10000"],
+             "chr1-0": [10.0, 3.0],
+             "chr1-10000": [3.0, 13.0]}),
+        sub_hic_matrix.hic_matrix_df)
+
+
+def test_sparse_div_by():
+    hic_matrix_1 = hicsuntdracones.hicmatrix.HiCMatrix(
+        "tests/fixtures/homer_matrix_small.txt", sparse=True)
+    hic_matrix_2 = hicsuntdracones.hicmatrix.HiCMatrix(
+        "tests/fixtures/homer_matrix_small.txt", sparse=True)
+    diff_hic_matrix = hic_matrix_1.div_by(hic_matrix_2, pseudocount=1.0)
+    assert diff_hic_matrix.is_sparse()
+    np.testing.assert_array_equal(
+        diff_hic_matrix.matrix_values().sparse.to_dense().to_numpy(),
+        np.ones((4, 4)))
+
+
+def test_sparse_calc_distance_dependent_decay():
+    chroms_dists_and_countings = hicsuntdracones.hicmatrix.HiCMatrix(
+        "tests/fixtures/homer_matrix.csv").calc_distance_dependent_decay(
+            10000)
+    sparse_chroms_dists_and_countings = hicsuntdracones.hicmatrix.HiCMatrix(
+        "tests/fixtures/homer_matrix.csv",
+        sparse=True).calc_distance_dependent_decay(10000)
+    for chrom in ["chr1", "chr2"]:
+        for key in ["dists", "countings"]:
+            np.testing.assert_array_equal(
+                chroms_dists_and_countings[chrom][key],
+                sparse_chroms_dists_and_countings[chrom][key])
+
+
+def test_select_region():
+    hic_matrix = hicsuntdracones.hicmatrix.HiCMatrix(
+        "tests/fixtures/homer_matrix.csv")
+    sub_hic_matrix = hic_matrix.select_region("chr2")
+    assert sub_hic_matrix.bins().tolist() == [
+        "chr2-0", "chr2-10000", "chr2-20000", "chr2-30000", "chr2-40000",
+        "chr2-50000", "chr2-60000"]
+    assert np.shares_memory(sub_hic_matrix._values, hic_matrix._values)
+    np.testing.assert_array_equal(
+        sub_hic_matrix._values,
+        hic_matrix.select(keep_pattern="chr2")._values)
+
+
+def test_select_region_range():
+    hic_matrix = hicsuntdracones.hicmatrix.HiCMatrix(
+        "tests/fixtures/homer_matrix.csv")
+    sub_hic_matrix = hic_matrix.select_region(
+        "chr1:15,000-30,000", "chr2:0-10000")
+    assert sub_hic_matrix.bins().tolist() == [
+        "chr1-10000", "chr1-20000", "chr2-0"]
+    assert sub_hic_matrix.chromosomes == ["chr1", "chr2"]
+    np.testing.assert_array_equal(
+        sub_hic_matrix._values,
+        hic_matrix._values[np.ix_([1, 2, 5], [1, 2, 5])])
+
+
+def test_select_region_sparse():
+    hic_matrix = hicsuntdracones.hicmatrix.HiCMatrix(
+        "tests/fixtures/homer_matrix.csv")
+    sparse_hic_matrix = hicsuntdracones.hicmatrix.HiCMatrix(
+        "tests/fixtures/homer_matrix.csv", sparse=True)
+    sub_hic_matrix = sparse_hic_matrix.select_region(
+        "chr1:15000-30000", "chr2")
+    assert sub_hic_matrix.is_sparse()
+    positions = [1, 2, 5, 6, 7, 8, 9, 10, 11]
+    np.testing.assert_array_equal(
+        sub_hic_matrix._dense_values(),
+        hic_matrix._values[np.ix_(positions, positions)])
+
+
+def test_lazy_loading():
+    hic_matrix = hicsuntdracones.hicmatrix.HiCMatrix(
+        "tests/fixtures/homer_matrix.csv", lazy=True)
+    assert hic_matrix._loaded_values is None
+    assert hic_matrix.number_of_bins == 12
+    assert hic_matrix.chromosomes == ["chr1", "chr2"]
+    assert hic_matrix._loaded_values is None
+    pd.testing.assert_frame_equal(
+        hic_matrix.matrix_values(),
+        hicsuntdracones.hicmatrix.HiCMatrix(
+            "tests/fixtures/homer_matrix.csv").matrix_values())
+    assert hic_matrix._loaded_values is not None
+
+
+def test_dtype(tmp_path):
+    hic_matrix = hicsuntdracones.hicmatrix.HiCMatrix(
+        "tests/fixtures/homer_matrix.csv", dtype="float32")
+    assert hic_matrix.matrix_values().dtypes.unique().tolist() == [
+        np.float32]
+    hic_matrix.normalize_by_columns_sum()
+    assert hic_matrix._values.dtype == np.float32
+    assert hic_matrix.div_by(hic_matrix)._values.dtype == np.float32
+    assert hic_matrix.select_region("chr2")._values.dtype == np.float32
+    output_file = str(tmp_path / "matrix.txt")
+    hic_matrix.save(output_file)
+    saved_hic_matrix = hicsuntdracones.hicmatrix.HiCMatrix(
+        output_file, dtype="float32")
+    np.testing.assert_array_equal(saved_hic_matrix._values,
+                                  hic_matrix._values)
+    sparse_hic_matrix = hicsuntdracones.hicmatrix.HiCMatrix(
+        "tests/fixtures/homer_matrix.csv", sparse=True, dtype="float32")
+    assert sparse_hic_matrix._values.dtype == np.float32
+
+
+def test_read_hic_matrix_binary_cache_dtype(tmp_path):
+    matrix_file = str(tmp_path / "matrix.txt")
+    shutil.copy("tests/fixtures/homer_matrix.csv", matrix_file)
+    hicsuntdracones.hicmatrix.read_hic_matrix(
+        matrix_file, dtype="float32", use_cache=True)
+    assert os.path.exists(matrix_file + ".float32.hicsd.npy")
+    assert not os.path.exists(matrix_file + ".hicsd.npy")
+    cached = hicsuntdracones.hicmatrix.read_hic_matrix(
+        matrix_file, dtype="float32", use_cache=True)
+    assert isinstance(cached._values, np.memmap)
+    assert cached._values.dtype == np.float32
+
+
+def test_normalize_by_columns_sum_not_inplace():
+    hic_matrix = hicsuntdracones.hicmatrix.HiCMatrix(
+        "tests/fixtures/homer_matrix.csv")
+    original_values = hic_matrix._values.copy()
+    normalized_hic_matrix = hic_matrix.normalize_by_columns_sum(
+        inplace=False)
+    np.testing.assert_array_equal(hic_matrix._values, original_values)
+    hic_matrix.normalize_by_columns_sum()
+    np.testing.assert_array_equal(normalized_hic_matrix._values,
+                                  hic_matrix._values)
+    pd.testing.assert_frame_equal(normalized_hic_matrix.hic_matrix_df,
+                                  hic_matrix.hic_matrix_df)
+
+
+def test_div_hic_matrix_files(tmp_path):
+    output_file = str(tmp_path / "ratios.txt")
+    expected_output_file = str(tmp_path / "expected_ratios.txt")
+    hicsuntdracones.hicmatrix.div_hic_matrix_files(
+        "tests/fixtures/homer_matrix.csv", "tests/fixtures/homer_matrix.csv",
+        output_file, pseudocount=0.5, norm_by_col_sum=True, chunk_size=5)
+    hic_matrix = hicsuntdracones.hicmatrix.HiCMatrix(
+        "tests/fixtures/homer_matrix.csv")
+    hic_matrix.normalize_by_columns_sum()
+    hic_matrix.div_by(hic_matrix, pseudocount=0.5).save(
+        expected_output_file)
+    with open(output_file) as output_fh, open(
+            expected_output_file) as expected_output_fh:
+        assert output_fh.read() == expected_output_fh.read()
+    with pytest.raises(SystemExit):
+        hicsuntdracones.hicmatrix.div_hic_matrix_files(
+            "tests/fixtures/homer_matrix.csv",
+            "tests/fixtures/homer_matrix.csv", str(tmp_path / "ratios.cool"))
+
+
+def test_packed_matrix_values():
+    hic_matrix = hicsuntdracones.hicmatrix.HiCMatrix(
+        "tests/fixtures/homer_matrix_small.txt", packed=True)
+    assert hic_matrix.is_packed()
+    np.testing.assert_array_equal(
+        hic_matrix._values,
+        np.array([10.0, 3.0, 0.0, 7.0, 13.0, 0.0, 4.0, 0.0, 0.0, 9.0]))
+    np.testing.assert_array_equal(
+        hic_matrix.matrix_values().to_numpy(),
+        np.array([[10.0, 3.0, 0.0, 7.0],
+                  [3.0, 13.0, 0.0, 4.0],
+                  [0.0, 0.0, 0.0, 0.0],
+                  [7.0, 4.0, 0.0, 9.0]]))
+
+
+def test_packed_operations(tmp_path):
+    hic_matrix = hicsuntdracones.hicmatrix.HiCMatrix(
+        "tests/fixtures/homer_matrix.csv")
+    packed_hic_matrix = hicsuntdracones.hicmatrix.HiCMatrix(
+        "tests/fixtures/homer_matrix.csv", packed=True)
+    pd.testing.assert_frame_equal(
+        hic_matrix.select_region("chr1", "chr2:20000-40000").hic_matrix_df,
+        packed_hic_matrix.select_region(
+            "chr1", "chr2:20000-40000").hic_matrix_df)
+    assert packed_hic_matrix.select(keep_pattern="chr2").is_packed()
+    hic_matrix.normalize_by_columns_sum()
+    packed_hic_matrix.normalize_by_columns_sum()
+    np.testing.assert_allclose(packed_hic_matrix.matrix_values().to_numpy(),
+                               hic_matrix.matrix_values().to_numpy())
+    diff_hic_matrix = packed_hic_matrix.div_by(packed_hic_matrix)
+    assert diff_hic_matrix.is_packed()
+    np.testing.assert_array_equal(
+        diff_hic_matrix.matrix_values().to_numpy(), np.ones((12, 12)))
+    output_file = str(tmp_path / "matrix.txt")
+    packed_hic_matrix.save(output_file, chunk_size=5)
+    pd.testing.assert_frame_equal(
+        hicsuntdracones.hicmatrix.HiCMatrix(output_file).hic_matrix_df,
+        hicsuntdracones.hicmatrix.HiCMatrix(
+            output_file, packed=True).hic_matrix_df)
+
+
+def test_packed_calc_distance_dependent_decay():
+    chroms_dists_and_countings = hicsuntdracones.hicmatrix.HiCMatrix(
+        "tests/fixtures/homer_matrix.csv").calc_distance_dependent_decay(
+            10000)
+    packed_chroms_dists_and_countings = hicsuntdracones.hicmatrix.HiCMatrix(
+        "tests/fixtures/homer_matrix.csv",
+        packed=True).calc_distance_dependent_decay(10000)
+    for chrom in ["chr1", "chr2"]:
+        for key in ["dists", "countings"]:
+            np.testing.assert_array_equal(
+                chroms_dists_and_countings[chrom][key],
+                packed_chroms_dists_and_countings[chrom][key])
+
+
+def test_coarsen(layout_kwargs):
+    hic_matrix = hicsuntdracones.hicmatrix.HiCMatrix(
+        "tests/fixtures/homer_matrix_small.txt", **layout_kwargs)
+    coarse_matrix = hic_matrix.coarsen(2, chunk_size=3)
+    assert list(coarse_matrix.bins()) == ["chr1-0", "chr2-0"]
+    assert coarse_matrix._dense_values().tolist() == [
+        [29.0, 11.0], [11.0, 9.0]]
+    assert coarse_matrix.is_sparse() == hic_matrix.is_sparse()
+    assert coarse_matrix.is_packed() == hic_matrix.is_packed()
+
+
+def test_bin_names_without_start(layout_kwargs, tmp_path):
+    matrix_file = str(tmp_path / "bins.txt")
+    with open("tests/fixtures/homer_matrix_small.txt") as input_fh, open(
+            matrix_file, "w") as output_fh:
+        output_fh.write(input_fh.read().replace("chr2-", "bin"))
+    hic_matrix = hicsuntdracones.hicmatrix.read_hic_matrix(
+        matrix_file, **layout_kwargs)
+    assert hic_matrix.bins()[2] == "bin0"
+    assert hic_matrix.select(keep_pattern="chr1").number_of_bins == 2
+    with pytest.raises(SystemExit):
+        hic_matrix.select_region("chr1")
+
+
+def test_dense_row_blocks(layout_kwargs):
+    hic_matrix = hicsuntdracones.hicmatrix.HiCMatrix(
+        "tests/fixtures/homer_matrix_small.txt", **layout_kwargs)
+    row_blocks = list(hic_matrix._dense_row_blocks(chunk_size=3))
+    assert [start for start, _ in row_blocks] == [0, 3]
+    np.testing.assert_array_equal(
+        np.vstack([values for _, values in row_blocks]),
+        hic_matrix._dense_values())
+
+
+def test_scale_bins(layout_kwargs):
+    hic_matrix = hicsuntdracones.hicmatrix.HiCMatrix(
+        "tests/fixtures/homer_matrix_small.txt", **layout_kwargs)
+    hic_matrix.scale_bins([1, 3], 0.5)
+    assert hic_matrix._dense_values().tolist() == [
+        [10.0, 3.0, 0.0, 7.0],
+        [3.0, 6.5, 0.0, 2.0],
+        [0.0, 0.0, 0.0, 0.0],
+        [7.0, 2.0, 0.0, 4.5]]
+    rows, cols, values = hic_matrix.upper_triangle(nonzero=True)
+    assert rows.tolist() == [0, 0, 0, 1, 1, 3]
+    assert cols.tolist() == [0, 1, 3, 1, 3, 3]
+    assert values.tolist() == [10.0, 3.0, 7.0, 6.5, 2.0, 4.5]
+
+
+def test_scale_bin_patches(layout_kwargs):
+    hic_matrix = hicsuntdracones.hicmatrix.HiCMatrix(
+        "tests/fixtures/homer_matrix_small.txt", **layout_kwargs)
+    hic_matrix.scale_bin_patches(
+        [[0], [1, 3], np.array([3])], [2, 0.5, 3], chunk_size=3)
+    assert hic_matrix._dense_values().tolist() == [
+        [20.0, 3.0, 0.0, 7.0],
+        [3.0, 6.5, 0.0, 2.0],
+        [0.0, 0.0, 0.0, 0.0],
+        [7.0, 2.0, 0.0, 13.5]]
+
+
+def test_observed_over_expected(layout_kwargs):
+    expected_values = np.array([
+        [10 / 11.5, 1.0, 0.0, 7 / 2.75],
+        [1.0, 13 / 11.5, 0.0, 4 / 2.75],
+        [0.0, 0.0, 0.0, 0.0],
+        [7 / 2.75, 4 / 2.75, 0.0, 2.0]])
+    hic_matrix = hicsuntdracones.hicmatrix.HiCMatrix(
+        "tests/fixtures/homer_matrix_small.txt", **layout_kwargs)
+    np.testing.assert_allclose(
+        hic_matrix.observed_over_expected(
+            chunk_size=3)._dense_values(), expected_values)
+    hic_matrix.observed_over_expected(inplace=True)
+    np.testing.assert_allclose(hic_matrix._dense_values(),
+                               expected_values)
+
+
+def test_observed_over_expected_of_file(tmp_path):
+    hicsuntdracones.hicmatrix.observed_over_expected_of_file(
+        "tests/fixtures/homer_matrix_small.txt",
+        str(tmp_path / "obs_exp.txt"), chunk_size=3)
+    np.testing.assert_allclose(
+        hicsuntdracones.hicmatrix.HiCMatrix(
+            str(tmp_path / "obs_exp.txt"))._dense_values(),
+        hicsuntdracones.hicmatrix.HiCMatrix(
+            "tests/fixtures/homer_matrix_small.txt").observed_over_expected(
+                )._dense_values())
+
+
+def test_import_without_plotting_libraries():
+    # Checked in a new interpreter as other tests import them
+    result = subprocess.run(
+        [sys.executable, "-c", "import sys, hicsuntdracones.hicmatrix; "
+         "print(sorted({'matplotlib.pyplot', 'seaborn', 'holoviews'} & "
+         "set(sys.modules)))"],
+        capture_output=True, text=True, check=True,
+        env=dict(os.environ, PYTHONPATH=os.getcwd()))
+    assert result.stdout.strip() == "[]"
+
+
+def _run_hicsd(*args):
+    return subprocess.run(
+        [sys.executable, "bin/hicsd"] + list(args), capture_output=True,
+        text=True, env=dict(os.environ, PYTHONPATH=os.getcwd()))
+
+
+def test_cli_obs_exp_streaming(tmp_path):
+    cooler_file = str(tmp_path / "matrix.cool")
+    hicsuntdracones.hicmatrix.HiCMatrix(
+        "tests/fixtures/homer_matrix_small.txt").save(cooler_file)
+    result = _run_hicsd("obs_exp", "-m", cooler_file,
+                        "-o", str(tmp_path / "obs_exp.txt"), "--streaming")
+    assert result.returncode == 1
+    assert "can not be streamed" in result.stderr
+    for flag in ("--sparse", "--packed"):
+        result = _run_hicsd(
+            "obs_exp", "-m", "tests/fixtures/homer_matrix_small.txt",
+            "-o", str(tmp_path / "obs_exp.txt"), "--streaming", flag)
+        assert result.returncode == 1
+        assert "can not be combined" in result.stderr
+    assert not os.path.exists(tmp_path / "obs_exp.txt")
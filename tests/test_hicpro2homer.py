@@ -1,4 +1,6 @@
+import numpy as np
 import pandas as pd
+import pytest
 import hicsuntdracones.hicpro2homer
 import os
 import hashlib
@@ -21,3 +23,54 @@ def test_hicpro2homer():
     md5_wanted_homer_table = hashlib.md5(open("tests/fixtures/homer_matrix.txt", sep="\t").read()).hexdigest()
     assert md5_outer_homer_table == md5_wanted_homer_table
 '''
+
+
+def test_symmetric_cells():
+    pair_value_table = pd.DataFrame({"bin_a": [1, 1, 2, 3, 9],
+                                     "bin_b": [1, 2, 1, 3, 1],
+                                     "counting": [5.0, 2.0, 4.0, 1.0, 7.0]})
+    rows, cols, values = hicsuntdracones.hicpro2homer.symmetric_cells(
+        pd.Series([1, 2, 3]), pair_value_table)
+    cells = dict(zip(zip(rows.tolist(), cols.tolist()), values.tolist()))
+    # The last value of a pair wins, unknown bins are skipped
+    assert cells == {(0, 0): 5.0, (0, 1): 4.0, (1, 0): 4.0, (2, 2): 1.0}
+
+
+def test_hicpro2homer_streaming():
+    tmp_output = "tests/fixtures/homer_matrix_streaming.txt"
+    tmp_wanted_output = "tests/fixtures/homer_matrix_in_memory.txt"
+    hicsuntdracones.hicpro2homer.hicpro2homer(
+        "tests/fixtures/hicpro_abs.bed",
+        "tests/fixtures/hicpro.matrix",
+        tmp_wanted_output)
+    hicsuntdracones.hicpro2homer.hicpro2homer_streaming(
+        "tests/fixtures/hicpro_abs.bed",
+        "tests/fixtures/hicpro.matrix",
+        tmp_output, chunk_size=7, rows_per_block=3)
+    assert open(tmp_output).read() == open(tmp_wanted_output).read()
+    os.remove(tmp_output)
+    os.remove(tmp_wanted_output)
+
+
+def test_merge_cells():
+    rows, cols, values = hicsuntdracones.hicpro2homer._merge_cells(
+        np.array([1, 3]), np.array([5, 5]), np.array([10, 30]),
+        np.array([3, 0, 1]), np.array([5, 4, 6]), np.array([31, 0, 11]))
+    assert rows.tolist() == [0, 1, 1, 3, 3]
+    assert cols.tolist() == [4, 5, 6, 5, 5]
+    assert values.tolist() == [0, 10, 11, 30, 31]
+
+
+@pytest.mark.parametrize(
+    "kwargs", [{}, {"sparse": False}, {"sparse": False, "packed": True}],
+    ids=["sparse", "dense", "packed"])
+def test_read_hic_pro(kwargs):
+    homer_table = hicsuntdracones.hicpro2homer.hic_pro_homer_table(
+        "tests/fixtures/hicpro_abs.bed", "tests/fixtures/hicpro.matrix")
+    hic_matrix = hicsuntdracones.hicpro2homer.read_hic_pro(
+        "tests/fixtures/hicpro_abs.bed", "tests/fixtures/hicpro.matrix",
+        **kwargs)
+    assert hic_matrix.is_sparse() == kwargs.get("sparse", True)
+    assert list(hic_matrix.bins()) == list(homer_table["Regions"])
+    assert (hic_matrix._dense_values() ==
+            homer_table.iloc[0:, 2:].to_numpy()).all()
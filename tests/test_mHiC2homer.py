@@ -0,0 +1,23 @@
+import pandas as pd
+import hicsuntdracones.mHiC2homer
+import os
+
+
+def test_mHiC2homer():
+    tmp_input = "tests/fixtures/mhic_interactions.txt"
+    tmp_output = "tests/fixtures/mhic_homer_matrix.txt"
+    with open(tmp_input, "w") as input_fh:
+        input_fh.write("chr10 0 chr2 1000\t3\n"
+                       "chr2 0 chr2 1000\t5\n"
+                       "chr2 0 chr2 0\t1\n"
+                       "chr2 1000 chr2 0\t2\n")
+    hicsuntdracones.mHiC2homer.mHiC2homer(tmp_input, tmp_output,
+                                          chunk_size=2)
+    output_homer_table = pd.read_csv(tmp_output, sep="\t", index_col=0)
+    bins = ["chr2-0", "chr2-1000", "chr10-0"]
+    # Bins are sorted naturally, the last value of a pair is used
+    assert list(output_homer_table.columns) == ["Regions"] + bins
+    assert output_homer_table[bins].values.tolist() == [
+        [1, 2, 0], [2, 0, 3], [0, 3, 0]]
+    os.remove(tmp_input)
+    os.remove(tmp_output)
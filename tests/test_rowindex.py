@@ -0,0 +1,48 @@
+import shutil
+import numpy as np
+import hicsuntdracones.hicmatrix
+import hicsuntdracones.rowindex
+
+
+def test_build_row_index():
+    row_index = hicsuntdracones.rowindex.build_row_index(
+        "tests/fixtures/homer_matrix_small.txt", chunk_size=3)
+    assert len(row_index) == 4
+    with open("tests/fixtures/homer_matrix_small.txt", "rb") as matrix_fh:
+        matrix_fh.readline()
+        for offset in row_index.offsets[:-1]:
+            assert matrix_fh.tell() == offset
+            matrix_fh.readline()
+        assert matrix_fh.tell() == row_index.offsets[-1]
+    np.testing.assert_array_equal(row_index.row_sums, [20, 20, 0, 20])
+    assert row_index.column_sum_median() == 20.0
+    assert row_index.min_value() == 0
+
+
+def test_read_rows():
+    row_index = hicsuntdracones.rowindex.build_row_index(
+        "tests/fixtures/homer_matrix.csv")
+    hic_matrix = hicsuntdracones.hicmatrix.HiCMatrix(
+        "tests/fixtures/homer_matrix.csv")
+    rows = np.array([1, 2, 5, 11])
+    np.testing.assert_array_equal(
+        row_index.read_rows("tests/fixtures/homer_matrix.csv", rows),
+        hic_matrix._values[rows])
+    np.testing.assert_array_equal(
+        row_index.read_rows("tests/fixtures/homer_matrix.csv", rows,
+                            columns=rows),
+        hic_matrix._values[np.ix_(rows, rows)])
+
+
+def test_read_hic_matrix_with_row_index(tmp_path):
+    matrix_file = str(tmp_path / "matrix.txt")
+    shutil.copy("tests/fixtures/homer_matrix.csv", matrix_file)
+    hic_matrix = hicsuntdracones.hicmatrix.read_hic_matrix(
+        matrix_file, row_index=True)
+    assert hicsuntdracones.rowindex.row_index_is_current(matrix_file)
+    sub_hic_matrix = hic_matrix.select_region("chr2:10000-40000")
+    assert hic_matrix._loaded_values is None
+    np.testing.assert_array_equal(
+        sub_hic_matrix._values,
+        hicsuntdracones.hicmatrix.HiCMatrix(matrix_file).select_region(
+            "chr2:10000-40000")._values)
@@ -0,0 +1,32 @@
+import numpy as np
+import pytest
+import hicsuntdracones.hicmatrix
+import hicsuntdracones.sharedmatrix
+
+
+@pytest.mark.parametrize("inherit", [True, False])
+def test_shared_hic_matrix(layout_kwargs, inherit):
+    hic_matrix = hicsuntdracones.hicmatrix.HiCMatrix(
+        "tests/fixtures/homer_matrix_small.txt", **layout_kwargs)
+    with hicsuntdracones.sharedmatrix.shared_hic_matrix(
+            hic_matrix, inherit=inherit) as shared_matrix:
+        loaded_matrix = shared_matrix.load()
+        assert list(loaded_matrix.bins()) == list(hic_matrix.bins())
+        assert loaded_matrix.is_sparse() == hic_matrix.is_sparse()
+        assert loaded_matrix.is_packed() == hic_matrix.is_packed()
+        np.testing.assert_array_equal(loaded_matrix._dense_values(),
+                                      hic_matrix._dense_values())
+
+
+def test_shared_hic_matrix_values_file(tmp_path):
+    values_file = str(tmp_path / "values.npy")
+    hic_matrix = hicsuntdracones.hicmatrix.HiCMatrix(
+        "tests/fixtures/homer_matrix_small.txt")
+    np.save(values_file, hic_matrix._values)
+    with hicsuntdracones.sharedmatrix.shared_hic_matrix(
+            hic_matrix, values_file=values_file,
+            inherit=False) as shared_matrix:
+        loaded_matrix = shared_matrix.load()
+        assert isinstance(loaded_matrix._values, np.memmap)
+        np.testing.assert_array_equal(loaded_matrix._dense_values(),
+                                      hic_matrix._dense_values())